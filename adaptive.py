@@ -0,0 +1,130 @@
+#! /usr/bin/env python
+"""Run a study in rounds, until every formation's tally is good enough.
+
+   Instead of a fixed number of runs per formation, each round generates
+   a batch of decks (getdecks.py) for the formations whose combined tally
+   relative error (see results.combine) is still above the target, runs
+   them (with localrun.py, or any command that runs mcnprun to
+   completion), and harvests the outputs into the results store
+   (ouextract.py --store). Formations that converge early stop getting
+   runs, so the CPU time goes to the ones that need it. For testing,
+   --replace mcnp611.sh=fakemcnp.py runs the stand-in MCNP.
+"""
+import argparse
+import csv
+import subprocess
+import sys
+from glob import glob
+
+import getdecks
+import instrument
+import localrun
+import ouextract
+import results
+
+
+def write_estimates(storefile, estimatefile):
+    "Write the combined estimate of every formation in the store to a csv"
+    store = results.ResultsStore(storefile)
+    try:
+        fp = open(estimatefile, 'w', newline='')
+        writer = csv.DictWriter(fp, results.ESTIMATE_COLUMNS)
+        writer.writeheader()
+        writer.writerows(store.estimates())
+        fp.close()
+    finally:
+        store.close()
+
+
+def count_pending(storefile, manifestfile, target_relerr):
+    "Return how many of the formations in the manifest miss the target"
+    formations = set(record['formation'] for record in
+                     results.read_manifest_records(manifestfile).values())
+    store = results.ResultsStore(storefile)
+    try:
+        return sum(1 for formation in formations
+                   if not store.is_done(formation, 0, target_relerr))
+    finally:
+        store.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Run MCNP on the formations of XRD.csv in rounds until "
+                    "each tally reaches a target relative error")
+    parser.add_argument('--target-relerr', type=float, default=0.05,
+                        help="relative error of the combined tally to reach")
+    parser.add_argument('--initial', type=int, default=2,
+                        help="runs per formation in the first round")
+    parser.add_argument('--batch', type=int, default=2,
+                        help="runs per unfinished formation in later rounds")
+    parser.add_argument('--max-rounds', type=int, default=10)
+    parser.add_argument('--store', default='results.sqlite',
+                        help="results store the rounds are judged by")
+    parser.add_argument('--estimates', default='estimates.csv',
+                        help="csv for the final combined estimates")
+    parser.add_argument('--study-seed', type=int, default=0)
+    parser.add_argument('-i', '--input', default='XRD.csv',
+                        help="XRD table")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of jobs localrun.py runs at once")
+    parser.add_argument('--replace', action='append', default=[],
+                        metavar='NAME=PATH',
+                        help="passed on to localrun.py")
+    parser.add_argument('--runner',
+                        help="shell command that runs the jobs of mcnprun "
+                             "and waits for them, instead of localrun.py")
+    parser.add_argument('--report', default='adaptive-report.json',
+                        help="JSON file for the run's stage timings and "
+                             "counters ('' for none)")
+    args = parser.parse_args(args)
+    manifestfile = 'manifest.csv'
+    with instrument.session(args.report, program='adaptive'):
+        # carry on after the decks of earlier invocations, so that their
+        # seeds are not run again
+        first_deck = getdecks.get_next_deck(args.store, manifestfile)
+        for round_number in range(args.max_rounds):
+            repeats = args.initial if round_number == 0 else args.batch
+            with instrument.stage('generate'):
+                getdecks.main(['-i', args.input, '--store', args.store,
+                               '--target-relerr', str(args.target_relerr),
+                               '--repeats', str(repeats),
+                               '--first-deck', str(first_deck),
+                               '--study-seed', str(args.study_seed),
+                               '--report', ''])
+            last_deck = results.get_last_deck(manifestfile)
+            if last_deck == 0:
+                break
+            num_decks = len(results.read_manifest_records(manifestfile))
+            instrument.count('rounds')
+            instrument.count('runs', num_decks)
+            with instrument.stage('run'):
+                if args.runner:
+                    status = subprocess.call(args.runner, shell=True)
+                else:
+                    replace = []
+                    for item in args.replace:
+                        replace += ['--replace', item]
+                    status = localrun.main(['mcnprun', '-j', str(args.jobs)]
+                                           + replace)
+            if status != 0:
+                sys.stderr.write("round %d: some runs failed\n"
+                                 % (round_number + 1))
+            with instrument.stage('harvest'):
+                rows = ouextract.harvest(glob('*ou'))
+                ouextract.store_results(rows, args.store, manifestfile)
+            pending = count_pending(args.store, manifestfile,
+                                    args.target_relerr)
+            sys.stdout.write("round %d: %d runs, %d formations still above "
+                             "%g relative error\n"
+                             % (round_number + 1, num_decks, pending,
+                                args.target_relerr))
+            first_deck = last_deck + 1
+            if pending == 0:
+                break
+        write_estimates(args.store, args.estimates)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,333 @@
+#! /usr/bin/env python
+"""Throughput and peak-memory benchmarks for deck generation and harvesting.
+
+   Runs the hot paths of getdecks, mcnpelements and ouextract on synthetic
+   XRD tables and MCNP output files, prints items/s and peak traced memory
+   for each, and compares the rates with a stored baseline:
+
+       python benchmarks.py --sizes 10,1000 --save       # record a baseline
+       python benchmarks.py --sizes 10,1000              # compare with it
+"""
+import argparse
+import gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import getdecks
+import mcnpelements as el
+import ouextract
+
+
+def synthetic_xrd(num_rows, seed=0):
+    """Return a random XRD table with the columns of XRD.csv"""
+    rng = np.random.RandomState(seed)
+    minerals = getdecks.XRD_MINERALS + ('illite_mica', 'illite_smectite')
+    # mostly sandstone, with a few percent of everything else
+    alpha = np.ones(len(minerals))
+    alpha[0] = 20.0
+    fracs = 100.0*rng.dirichlet(alpha, num_rows)
+    mixdf = pd.DataFrame(fracs, columns=minerals)
+    mixdf.insert(0, 'well', ['SYN-%d' % (n % 7) for n in range(num_rows)])
+    mixdf.insert(1, 'sample', np.arange(1, num_rows + 1))
+    mixdf.insert(2, 'depth', '1000-1005')
+    mixdf['total_clay'] = mixdf[['kaolinite', 'chlorite', 'illite_mica',
+                                 'illite_smectite']].sum(axis=1)
+    return mixdf
+
+
+def synthetic_ou(num_lines=100000, seed=0):
+    """Return the text of an MCNP output file that examine_file can read,
+       padded to about 'num_lines' lines"""
+    rng = np.random.RandomState(seed)
+    lines = ["1mcnp     version 6     ld=05/08/13  %s" % time.ctime(0),
+             "          Quick room shielding test",
+             "c    ===       Shield material : water",
+             "c    ===       Shield thickness: 12.0 cm"]
+    lines += ["      %5d- c filler line %d" % (n, n)
+              for n in range(max(0, num_lines - 40))]
+    lines += [" results of 10 statistical checks for the estimated answer",
+              " the tally in the tally fluctuation chart bin passed the 10"
+              " statistical checks.",
+              "1tally fluctuation charts",
+              "",
+              "                            tally        4",
+              "          nps      mean     error   vov  slope    fom"]
+    for n in range(1, 15):
+        lines.append("      %7d   %.4E %.4f %.4f %4.1f %.1E" % (
+            500000*n, rng.uniform(1e-6, 1e-5), 0.1/np.sqrt(n),
+            0.01/n, 10.0, 1.0e3))
+    lines += ["", " ***********************************************",
+              " dump no.    2 on file s00001ta", ""]
+    return "\n".join(lines) + "\n"
+
+
+def _run(func, repeat):
+    best = None
+    for n in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def _peak_memory(func):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench(name, func, items, repeat=3, memory=True):
+    """Time 'func', which handles 'items' items, and return a result dict
+       with its best time, rate and (optionally) peak traced memory"""
+    seconds = _run(func, repeat)
+    result = {'name': name, 'items': items, 'seconds': seconds,
+              'rate': items/seconds if seconds > 0 else float('inf')}
+    if memory:
+        result['peak_bytes'] = _peak_memory(func)
+    return result
+
+
+def get_benchmarks(num_rows, workdir, limit=10000, ou_limit=200,
+                   ou_lines=100000):
+    """Return (name, func, items) for each benchmark at table size
+       'num_rows'. The per-item paths are run on at most 'limit' items
+       (and 'ou_limit' output files) to keep large sizes affordable."""
+    mixdf = synthetic_xrd(num_rows)
+    small = mixdf.iloc[:min(num_rows, limit)]
+    n_small = len(small)
+    rows = [row for idx, row in small.iterrows()]
+    sweep = getdecks.get_sweep((20.0,), (0,), (20,))
+    formulas = [getdecks.MATERIALS[mat]['formula']
+                for mat in sorted(getdecks.MATERIALS)]
+    formulas = [formulas[n % len(formulas)] for n in range(n_small)]
+    comps = [getdecks.get_compositions()[mat]
+             for mat in getdecks.XRD_MINERALS]
+    mass_fracs = (small.loc[:, getdecks.XRD_MINERALS].to_numpy()/100.0).tolist()
+    densities, elem_fracs = getdecks.mix_formations(small, sweep)
+    elem_fracs = elem_fracs.reshape(-1, len(el.ELEMENT_ORDER))
+    names = ['formation %d' % n for n in range(n_small)]
+    compacts = [el.CompactComposition(fracs) for fracs in elem_fracs]
+
+    fp = open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'ctn8tmpl'))
+    template_text = fp.read()
+    fp.close()
+    pct_template = getdecks.PctTemplate(template_text)
+    deck_template = getdecks.DeckTemplate(template_text)
+    d = {'date': '2000-01-01', 'filename': 's00001in',
+         'formation': names[0],
+         'formation_card': el.get_material_cards(names[:1], densities[0],
+                                                 elem_fracs[:1], 3)[0],
+         'formation_density': float(densities[0, 0]), 'porosity': 20.0,
+         'pct_mica': 0, 'pct_smectite': 20, 'rand_seed': 12345}
+    bound = deck_template.bind(dict((key, d[key]) for key in d
+                                    if key not in ('filename', 'rand_seed')))
+
+    n_ou = min(num_rows, ou_limit)
+    oudir = os.path.join(workdir, 'ou')
+    os.mkdir(oudir)
+    oufiles = []
+    text = synthetic_ou(ou_lines)
+    for n in range(n_ou):
+        oufile = os.path.join(oudir, 's%05dou' % (n + 1))
+        fp = open(oufile, 'w')
+        fp.write(text)
+        fp.close()
+        oufiles.append(oufile)
+    deckdir = os.path.join(workdir, 'decks')
+
+    def parse_formulas():
+        for formula in formulas:
+            el.ElementalComposition(formula)
+
+    def add_by_mass_fracs():
+        for fracs in mass_fracs:
+            el.add_compositions_by_mass_fracs(comps, fracs)
+
+    def get_card():
+        getdecks.clear_caches()
+        for row in rows:
+            getdecks.get_card(row, 20.0, 0, 20)
+
+    def get_card_cached():
+        # after the first of the repeats, every card comes from the cache
+        for row in rows:
+            getdecks.get_card(row, 20.0, 0, 20)
+
+    def get_material_card():
+        for name, fracs in zip(names, elem_fracs):
+            el.get_material_card(name, 2.5, el.CompactComposition(fracs).to_dict(), 3)
+
+    def get_material_cards():
+        el.get_material_cards(names, densities.ravel(), elem_fracs, 3)
+
+    def compact_ops():
+        total = el.CompactComposition()
+        for comp in compacts:
+            total += 0.5*comp
+        total.norm_fracs_to_one()
+        total.separate_isotopes()
+
+    def mix_formations():
+        getdecks.mix_formations(mixdf, sweep)
+
+    def get_cards():
+        getdecks.clear_caches()
+        for card in getdecks.get_cards(small, sweep):
+            pass
+
+    def substitute():
+        for n in range(n_small):
+            pct_template.substitute(d)
+
+    def render():
+        for n in range(n_small):
+            bound.render(d)
+
+    def write_decks():
+        if os.path.exists(deckdir):
+            shutil.rmtree(deckdir)
+        os.mkdir(deckdir)
+        cwd = os.getcwd()
+        os.chdir(deckdir)
+        try:
+            getdecks.write_decks(deck_template, small, sweep, 1,
+                                 range(1, n_small + 1))
+        finally:
+            os.chdir(cwd)
+
+    def examine_file():
+        for oufile in oufiles:
+            fp = open(oufile)
+            ouextract.examine_file(fp.readlines())
+            fp.close()
+
+    def examine_ou():
+        for oufile in oufiles:
+            ouextract.examine_ou(oufile)
+
+    return [('ElementalComposition', parse_formulas, n_small),
+            ('add_compositions_by_mass_fracs', add_by_mass_fracs, n_small),
+            ('get_card', get_card, n_small),
+            ('get_card (cached)', get_card_cached, n_small),
+            ('get_material_card', get_material_card, n_small),
+            ('get_material_cards', get_material_cards, n_small),
+            ('CompactComposition', compact_ops, n_small),
+            ('mix_formations', mix_formations, num_rows),
+            ('get_cards', get_cards, n_small),
+            ('PctTemplate.substitute', substitute, n_small),
+            ('DeckTemplate.render', render, n_small),
+            ('write_decks', write_decks, n_small),
+            ('examine_file', examine_file, n_ou),
+            ('examine_ou', examine_ou, n_ou)]
+
+
+def compare(results, baseline, tolerance):
+    """Mark each result with its rate relative to the baseline, and return
+       the results more than 'tolerance' slower than it"""
+    regressions = []
+    for result in results:
+        key = '%s[%d]' % (result['name'], result['size'])
+        if key in baseline:
+            result['ratio'] = result['rate']/baseline[key]
+            if result['ratio'] < 1 - tolerance:
+                regressions.append(result)
+    return regressions
+
+
+def print_results(results, fp=sys.stdout):
+    fp.write("%-32s %8s %8s %12s %10s %11s %7s\n" % (
+        'benchmark', 'size', 'items', 'items/s', 'seconds', 'peak MiB',
+        'vs base'))
+    for result in results:
+        ratio = result.get('ratio')
+        peak = result.get('peak_bytes')
+        fp.write("%-32s %8d %8d %12.1f %10.4f %11s %7s\n" % (
+            result['name'], result['size'], result['items'], result['rate'],
+            result['seconds'],
+            '%.2f' % (peak/2.0**20) if peak is not None else '-',
+            '%.2f' % ratio if ratio is not None else '-'))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark deck generation and output harvesting")
+    parser.add_argument('--sizes', default='10,1000',
+                        help="comma-separated synthetic XRD table sizes, "
+                             "e.g. 10,1000,100000,1000000")
+    parser.add_argument('--only', help="comma-separated benchmark names")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="timing runs per benchmark (the best is kept)")
+    parser.add_argument('--limit', type=int, default=10000,
+                        help="most items for the per-item paths")
+    parser.add_argument('--ou-lines', type=int, default=100000,
+                        help="lines per synthetic output file")
+    parser.add_argument('--no-memory', action='store_true',
+                        help="skip the peak memory runs")
+    parser.add_argument('--baseline', default='benchmarks_baseline.json',
+                        help="stored rates to compare with")
+    parser.add_argument('--save', action='store_true',
+                        help="store these rates as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed fractional slowdown from the baseline")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(args)
+
+    only = set(args.only.split(',')) if args.only else None
+    results = []
+    for size in [int(float(size)) for size in args.sizes.split(',')]:
+        workdir = tempfile.mkdtemp(prefix='bench')
+        try:
+            for name, func, items in get_benchmarks(size, workdir, args.limit,
+                                                    ou_lines=args.ou_lines):
+                if only is not None and name not in only:
+                    continue
+                result = bench(name, func, items, args.repeat,
+                               not args.no_memory)
+                result['size'] = size
+                results.append(result)
+        finally:
+            shutil.rmtree(workdir)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        fp = open(args.baseline)
+        baseline = json.load(fp)
+        fp.close()
+    regressions = compare(results, baseline, args.tolerance)
+    print_results(results)
+    if args.json:
+        fp = open(args.json, 'w')
+        json.dump(results, fp, indent=1)
+        fp.close()
+    if args.save:
+        baseline.update(('%s[%d]' % (result['name'], result['size']),
+                         result['rate']) for result in results)
+        fp = open(args.baseline, 'w')
+        json.dump(baseline, fp, indent=1, sort_keys=True)
+        fp.close()
+    elif regressions:
+        sys.stdout.write("Slower than the baseline: %s\n" % ", ".join(
+            '%s[%d]' % (result['name'], result['size'])
+            for result in regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+"""Stand-in for the MCNP executable, for testing runs without MCNP.
+
+   Takes MCNP's 'inp=... ou=...' arguments and writes an output file with
+   the lines ouextract.py reads: the statistical checks and a tally
+   fluctuation chart. The tally of a deck is made up from its formation
+   card and density, and its noise from its random seed, so every
+   formation has its own true dose and per-run relative error (between
+   about 2% and 20%) and repeated runs scatter around it like real ones.
+   Given 'mctal=...', it also writes the tally to a mctal file. Use it
+   with localrun.py --replace mcnp611.sh=fakemcnp.py.
+"""
+import hashlib
+import math
+import random
+import re
+import sys
+
+_RE_SEED = re.compile(r'^rand\b.*\bseed=(\d+)', re.MULTILINE | re.IGNORECASE)
+_RE_DENSITY = re.compile(r'^ *2 +3 +-(\S+)', re.MULTILINE)
+_RE_CARD = re.compile(r'^ +m3 .*?(?=^c)', re.MULTILINE | re.DOTALL)
+
+
+def get_tally(deck):
+    """Return the made-up (dose, relerr, rand_seed) of a run of 'deck',
+       the text of an input file"""
+    seed = int(_RE_SEED.search(deck).group(1))
+    density = float(_RE_DENSITY.search(deck).group(1))
+    card = _RE_CARD.search(deck)
+    digest = hashlib.sha256(card.group(0).encode('utf-8')
+                            if card else b'').digest()
+    u1, u2 = digest[0]/255.0, digest[1]/255.0
+    true_dose = 1.0e-5*math.exp(-2.0*(density - 2.0))*(1.0 + 0.5*u1)
+    true_relerr = 0.02 + 0.18*u2
+    rng = random.Random(seed)
+    relerr = true_relerr*abs(1.0 + 0.1*rng.gauss(0.0, 1.0))
+    dose = true_dose*(1.0 + true_relerr*rng.gauss(0.0, 1.0))
+    return max(dose, 1e-3*true_dose), relerr, seed
+
+
+def get_output(deck, title):
+    "Return the text of the output file of a run of 'deck'"
+    dose, relerr, seed = get_tally(deck)
+    lines = ["1mcnp     version 6 (stand-in)",
+             "          %s" % title,
+             "          rand gen=2 seed=%d" % seed]
+    if relerr < 0.1:
+        lines.append(" the tally in the tally fluctuation chart bin passed "
+                     "the 10 statistical checks.")
+    else:
+        lines.append(" %2d of 10 tfc bin checks were missed."
+                     % min(10, int(relerr*20)))
+    lines += ["1tally fluctuation charts",
+              "",
+              "                            tally        4",
+              "          nps      mean     error   vov  slope    fom"]
+    for n in range(1, 8):
+        lines.append("      %7d   %.4E %.4f %.4f %4.1f %.1E" % (
+            1000000*n, dose, relerr*math.sqrt(7.0/n), 0.01/n, 10.0, 1.0e3))
+    lines += ["", " ***********************************************"]
+    return "\n".join(lines) + "\n"
+
+
+def get_mctal(deck, title):
+    "Return the text of the mctal file of a run of 'deck'"
+    dose, relerr, seed = get_tally(deck)
+    lines = ["mcnp6     6     10/18/26 00:00:00     2      7000000 %15d"
+             % seed,
+             " %s" % title,
+             "ntal     1",
+             "    4",
+             "tally    4    1    0",
+             "f        1",
+             "       2",
+             "d        1"]
+    lines += ["%-2s       0" % name for name in ('u', 's', 'm', 'c', 'e', 't')]
+    lines += ["vals",
+              "  %.5E %.4f" % (dose, relerr),
+              "tfc    7       1       1       1       1       1       1"
+              "       1       1"]
+    for n in range(1, 8):
+        lines.append("    %11d  %.5E %.4f %.4E" % (
+            1000000*n, dose, relerr*math.sqrt(7.0/n), 1.0e3))
+    return "\n".join(lines) + "\n"
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    files = dict(arg.split('=', 1) for arg in args if '=' in arg)
+    fp = open(files['inp'])
+    deck = fp.read()
+    fp.close()
+    title = deck.split('\n', 1)[0]
+    fp = open(files.get('ou', files['inp'][:-2] + 'ou'), 'w')
+    fp.write(get_output(deck, title))
+    fp.close()
+    if 'mctal' in files:
+        fp = open(files['mctal'], 'w')
+        fp.write(get_mctal(deck, title))
+        fp.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,24 @@
 #! /usr/bin/env python
 
+import argparse
+import collections
+import csv
 import datetime
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import multiprocessing
+import os
+import pickle
+import re
 import random
-import numpy as np
-import pandas as pd
+import tarfile
+import time
+import instrument
 import mcnpelements as el
+import results
 from string import Template
 
 
@@ -12,6 +26,101 @@ class PctTemplate(Template):
     """string.Template class using '%' as the delimeter"""
     delimiter = '%'
 
+
+class DeckTemplate(object):
+    """A PctTemplate compiled once into literal chunks and placeholder slots.
+
+       render() joins the pre-encoded literal chunks with the encoded slot
+       values, so filling in a deck never re-scans the template text.
+       bind() fills in some of the placeholders and returns a smaller
+       DeckTemplate, so the formation-dependent text is rendered once per
+       formation and each repeat only splices in its filename and seed.
+       As with PctTemplate.substitute, a missing placeholder raises
+       KeyError, an invalid one ValueError, and extra keys are ignored.
+
+       >>> text = "c %{name} at %date, 100%% %name\\n"
+       >>> d = {'name': 'shale', 'date': '2000-01-01', 'extra': 1}
+       >>> bound = DeckTemplate(text).bind({'date': d['date']})
+       >>> bound.render(d) == PctTemplate(text).substitute(d).encode('utf-8')
+       True
+       >>> bound.render(d)
+       b'c shale at 2000-01-01, 100% shale\\n'
+       >>> bound.render({'date': '2000-01-01'})
+       Traceback (most recent call last):
+       ...
+       KeyError: 'name'
+       >>> DeckTemplate("c ok\\nc 5%-")
+       Traceback (most recent call last):
+       ...
+       ValueError: Invalid placeholder in string: line 2, col 4
+       >>> PctTemplate("c ok\\nc 5%-").substitute({})
+       Traceback (most recent call last):
+       ...
+       ValueError: Invalid placeholder in string: line 2, col 4
+    """
+    def __init__(self, template, encoding='utf-8'):
+        self.encoding = encoding
+        # identifies the template text in deck hashes (see write_decks)
+        self.digest = hashlib.sha256(template.encode(encoding)).hexdigest()
+        literals = ['']
+        slots = []
+        pos = 0
+        for m in PctTemplate.pattern.finditer(template):
+            literals[-1] += template[pos:m.start()]
+            pos = m.end()
+            name = m.group('named') or m.group('braced')
+            if name is not None:
+                slots.append(name)
+                literals.append('')
+            elif m.group('escaped') is not None:
+                literals[-1] += PctTemplate.delimiter
+            else:
+                lines = template[:m.start('invalid')].splitlines(True)
+                if not lines:
+                    colno, lineno = 1, 1
+                else:
+                    colno = m.start('invalid') - len(''.join(lines[:-1]))
+                    lineno = len(lines)
+                raise ValueError('Invalid placeholder in string: '
+                                 'line %d, col %d' % (lineno, colno))
+        literals[-1] += template[pos:]
+        self._set_parts([literal.encode(encoding) for literal in literals],
+                        slots)
+
+    def _set_parts(self, literals, slots):
+        self.slots = tuple(slots)
+        self._parts = [None]*(2*len(slots) + 1)
+        self._parts[0::2] = literals
+
+    def _encode(self, value):
+        return ('%s' % (value,)).encode(self.encoding)
+
+    def bind(self, mapping):
+        "Return a DeckTemplate with the placeholders in 'mapping' filled in"
+        literals = [self._parts[0]]
+        slots = []
+        for name, literal in zip(self.slots, self._parts[2::2]):
+            if name in mapping:
+                literals[-1] += self._encode(mapping[name]) + literal
+            else:
+                slots.append(name)
+                literals.append(literal)
+        bound = DeckTemplate.__new__(DeckTemplate)
+        bound.encoding = self.encoding
+        bound.digest = self.digest
+        bound._set_parts(literals, slots)
+        return bound
+
+    def render(self, mapping):
+        "Return the filled-in template as bytes"
+        parts = list(self._parts)
+        parts[1::2] = [self._encode(mapping[name]) for name in self.slots]
+        return b''.join(parts)
+
+    def substitute(self, mapping):
+        "Return the filled-in template as a string, like PctTemplate"
+        return self.render(mapping).decode(self.encoding)
+
 submit_header = """Executable = mcnp611.sh
 +AccountingGroup = "grant"
 Universe = vanilla
@@ -59,10 +168,97 @@ MATERIALS = {"muscovite": {'density': 2.810,
              "gypsum":      {"density": 2.3,   "formula": "CaSO4H4O2"},
              "water":       {"density": 0.9982071,   "formula": "H2O"},
             }
-for key in MATERIALS:
-    mat = MATERIALS[key]
-    mat['comp'] = el.ElementalComposition(mat['formula'])
-    mat['comp'].norm_fracs_to_one()
+
+# The compiled materials library, kept next to this module: every formula
+# of MATERIALS parsed and normalized once, for as long as MATERIALS and
+# mcnpelements.py are unchanged. Loaded on first use, so importing this
+# module reads no files.
+MATERIALS_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'materials.pickle')
+_LIBRARY = None
+_COMPOSITIONS = None
+_MINERAL_MATRIX = None
+
+
+def get_materials_hash(materials=None):
+    """Return the hash of what the compiled library of 'materials' (by
+       default MATERIALS) depends on: their densities and formulas, and
+       the formula parser in mcnpelements.py"""
+    if materials is None:
+        materials = MATERIALS
+    h = hashlib.sha256()
+    for name in sorted(materials):
+        h.update(('%s %r %s\n' % (name, materials[name]['density'],
+                                  materials[name]['formula'])).encode('utf-8'))
+    fp = open(el.__file__, 'rb')
+    h.update(fp.read())
+    fp.close()
+    return h.hexdigest()
+
+
+def compile_materials(materials=None):
+    """Return the compiled library of 'materials' (by default MATERIALS),
+       a dict of name -> (density, [(element, fraction), ...]), with the
+       fractions normalized to one and in the order of the formula"""
+    if materials is None:
+        materials = MATERIALS
+    library = {}
+    for name in materials:
+        comp = el.ElementalComposition(materials[name]['formula'])
+        comp.norm_fracs_to_one()
+        library[name] = (materials[name]['density'], list(comp.items()))
+    return library
+
+
+def load_materials(cachefile=None):
+    """Return the compiled library of MATERIALS from 'cachefile' (by
+       default MATERIALS_CACHE), compiling it and rewriting the cache if
+       the cache is missing or was compiled from other sources"""
+    if cachefile is None:
+        cachefile = MATERIALS_CACHE
+    source_hash = get_materials_hash()
+    try:
+        fp = open(cachefile, 'rb')
+        try:
+            cached = pickle.load(fp)
+        finally:
+            fp.close()
+        if cached['hash'] == source_hash:
+            return cached['materials']
+    except (OSError, EOFError, pickle.UnpicklingError, KeyError, TypeError,
+            ValueError):
+        pass
+    with instrument.stage('materials'):
+        library = compile_materials()
+    tmpfile = '%s.%d.tmp' % (cachefile, os.getpid())
+    try:
+        fp = open(tmpfile, 'wb')
+        pickle.dump({'hash': source_hash, 'materials': library}, fp,
+                    pickle.HIGHEST_PROTOCOL)
+        fp.close()
+        os.replace(tmpfile, cachefile)
+    except OSError:
+        pass  # e.g. a read-only install: compile again next time
+    return library
+
+
+def get_library():
+    "Return the compiled library of MATERIALS, loaded on first use"
+    global _LIBRARY
+    if _LIBRARY is None:
+        _LIBRARY = load_materials()
+    return _LIBRARY
+
+
+def get_compositions():
+    """Return a dict of MATERIALS name -> normalized ElementalComposition,
+       from the compiled library"""
+    global _COMPOSITIONS
+    if _COMPOSITIONS is None:
+        _COMPOSITIONS = dict((name, el.ElementalComposition(dict(fracs)))
+                             for name, (density, fracs)
+                             in get_library().items())
+    return _COMPOSITIONS
 
 
 def get_random_seed():
@@ -72,32 +268,58 @@ def get_random_seed():
     return random_seed
 
 
+# Deterministic seeds are odd numbers below 2**(_SEED_BITS + 1), fine for
+# MCNP's 63-bit generator (rand gen=2).
+_SEED_BITS = 46
+_SEED_MASK = (1 << _SEED_BITS) - 1
+
+
+def get_deck_seed(deck_number, study_seed=0):
+    """Return a reproducible odd random seed for deck 'deck_number'.
+
+       Each step below is a bijection on _SEED_BITS-bit integers, so
+       different deck numbers in one study always get different seeds, and
+       any host can compute the seed of any deck without coordination.
+       Consecutive deck numbers get unrelated seeds.
+    """
+    x = (deck_number ^ (study_seed*0x5851F42D4C957F2D)) & _SEED_MASK
+    x = (x*0x9E3779B97F4A7C15) & _SEED_MASK
+    x ^= x >> 23
+    x = (x*0xBF58476D1CE4E5B9) & _SEED_MASK
+    x ^= x >> 29
+    return 2*x + 1
+
+
 pct_tol = 1.0e-6
 rho_w = MATERIALS['water']['density']
 rho_q = MATERIALS['sandstone']['density']
 
 
+XRD_MINERALS = ('sandstone', 'orthoclase', 'plagioclase',
+                'limestone', 'dolomite', 'siderite',
+                'pyrite', 'gypsum', 'kaolinite',
+                'chlorite')
+# Column order of the batched mixing arrays: the XRD minerals, then the
+# clay end-members split out of illite_mica/illite_smectite, then pore water.
+MIX_MINERALS = XRD_MINERALS + ('muscovite', 'smectite', 'illite_1', 'water')
+
+
 def get_card(row, porosity=0.0, pct_mica=0.0, pct_smectite=20.0):
     rewt = 1.0 # re-weighting factor due to (possible) sandstone porosity
     v_w = float(porosity)/100.0
-    name = "Shale mixture for %s_%d (%d mica, %d smectite)" % (row['well'],
-                                                               row['sample'],
-                                                               pct_mica,
-                                                               pct_smectite)
+    name = get_name(row, pct_mica, pct_smectite)
+    comps = get_compositions()
     materials = []
     mass_fracs = []
     densities = []
     compositions = []
-    for mat in ('sandstone', 'orthoclase', 'plagioclase',
-                'limestone', 'dolomite', 'siderite',
-                'pyrite', 'gypsum', 'kaolinite',
-                'chlorite'):
+    for mat in XRD_MINERALS:
         frac = row[mat] / 100.0  # wt frac
         if frac > 0:
             materials.append(mat)
             mass_fracs.append(frac)
             densities.append(MATERIALS[mat]['density'])
-            compositions.append(MATERIALS[mat]['comp'])
+            compositions.append(comps[mat])
     mica_frac = pct_mica / 100.0  # wt fraction
     smectite_frac = pct_smectite / 100.0  # wt fraction
     illite_mica_frac = row['illite_mica'] / 100.0  # wt frac
@@ -106,21 +328,21 @@ def get_card(row, porosity=0.0, pct_mica=0.0, pct_smectite=20.0):
         materials.append('muscovite')
         mass_fracs.append(mat_mica_frac)
         densities.append(MATERIALS['muscovite']['density'])
-        compositions.append(MATERIALS['muscovite']['comp'])
+        compositions.append(comps['muscovite'])
     illite_smectite_frac = row['illite_smectite'] / 100.0  # wt frac
     mat_smectite_frac = smectite_frac*illite_smectite_frac
     if mat_smectite_frac > 0:
         materials.append('smectite')
         mass_fracs.append(mat_smectite_frac)
         densities.append(MATERIALS['smectite']['density'])
-        compositions.append(MATERIALS['smectite']['comp'])
+        compositions.append(comps['smectite'])
     illite_frac = (illite_mica_frac*(1 - mica_frac)
                 + illite_smectite_frac*(1 - smectite_frac))
     if illite_frac > 0:
         materials.append('illite_1')
         mass_fracs.append(illite_frac)
         densities.append(MATERIALS['illite_1']['density'])
-        compositions.append(MATERIALS['illite_1']['comp'])
+        compositions.append(comps['illite_1'])
     # dry matrix weight percentages might not quite sum to 1
     norm = sum(mass_fracs)
     mass_fracs = [frac/norm for frac in mass_fracs]
@@ -132,63 +354,1268 @@ def get_card(row, porosity=0.0, pct_mica=0.0, pct_smectite=20.0):
         materials.append('water')
         mass_fracs.append(lam)
         densities.append(MATERIALS['water']['density'])
-        compositions.append(MATERIALS['water']['comp'])
-        mass_fracs = rewt*np.array(mass_fracs)
-        densities = np.array(densities)
+        compositions.append(comps['water'])
+        mass_fracs = [rewt*frac for frac in mass_fracs]
 
-    density = 1/sum(mass_fracs/densities)
-    composition = el.add_compositions_by_mass_fracs(compositions, mass_fracs)
-    card = el.get_material_card(name, density, composition, 3)
+    density = 1/sum(frac/rho for frac, rho in zip(mass_fracs, densities))
+    card_key = (name, density, tuple(materials), tuple(mass_fracs), 3)
+    card = CARD_CACHE.get(card_key)
+    if card is None:
+        mix_key = get_mix_key(materials, mass_fracs)
+        composition = MIX_CACHE.get(mix_key)
+        if composition is None:
+            composition = el.add_compositions_by_mass_fracs(compositions,
+                                                            mass_fracs)
+            MIX_CACHE.put(mix_key, composition)
+        # get_material_card changes the composition it is given
+        card = el.get_material_card(name, density,
+                                    el.ElementalComposition(composition), 3)
+        CARD_CACHE.put(card_key, card)
     return density, name, card
 
 
-fp = open("ctn8tmpl")
-deck_template = fp.read()
-fp.close()
-deck_template = PctTemplate(deck_template)
-
-runfp = open("mcnprun", 'w')
-runfp.write(submit_header)
-runfp.write('\n')
-
-mixdf = pd.read_csv('XRD.csv')
-#mixdf = pd.read_csv('TESTXRD.csv')
-
-filenum = 1
-num_repeats = 10
-smectite_pcts = (20,)
-mica_pcts = (0,)
-for idx, row in mixdf.iterrows():
-    porosity = 20.0
-    for pct_mica in mica_pcts:
-        for pct_smectite in smectite_pcts:
-            formation_density, formation, formation_card = get_card(row,
-                                                                    porosity,
-                                                                    pct_mica,
-                                                                    pct_smectite)
+# Caches, so that a long-lived process asked for the same formations again
+# doesn't redo them. CARD_CACHE holds finished cards, keyed on the exact
+# name, density, mixture and material number, so a cached card is always
+# the card that would be made. MIX_CACHE holds get_card's composition of
+# each mixture (see get_mix_key), shared by all the rows and sweep points
+# that mix the same minerals in the same amounts. Set MIX_DIGITS to a number
+# of decimals to also share entries between mixtures that differ only by
+# rounding error.
+MIX_DIGITS = None
+MIX_CACHE = el.LRUCache(4096)
+CARD_CACHE = el.LRUCache(4096)
+
+
+def get_mix_key(materials, mass_fracs):
+    """Return the MIX_CACHE key of a mixture: the minerals and their exact
+       mass fractions, so a composition never depends on what is in the
+       cache. If MIX_DIGITS is set, the fractions are rounded to that many
+       decimals, and whichever of the mixtures that round alike was mixed
+       first decides the composition all of them get."""
+    if MIX_DIGITS is not None:
+        mass_fracs = [round(frac, MIX_DIGITS) for frac in mass_fracs]
+    return tuple(materials), tuple(mass_fracs)
+
+
+def set_cache_sizes(formulas=None, mixes=None, cards=None):
+    """Set the size limits of the caches of parsed formulas, mixtures and
+       cards (0 turns one off); None leaves a limit as it is"""
+    for cache, maxsize in ((el.FORMULA_CACHE, formulas), (MIX_CACHE, mixes),
+                           (CARD_CACHE, cards)):
+        if maxsize is not None:
+            cache.resize(maxsize)
+
+
+def get_cache_stats():
+    "Return the hits, misses, evictions and size of each cache"
+    return {'formulas': el.FORMULA_CACHE.stats(),
+            'mixes': MIX_CACHE.stats(),
+            'cards': CARD_CACHE.stats()}
+
+
+def clear_caches():
+    for cache in (el.FORMULA_CACHE, MIX_CACHE, CARD_CACHE):
+        cache.clear()
+
+
+def get_name(row, pct_mica, pct_smectite):
+    return "Shale mixture for %s_%d (%d mica, %d smectite)" % (row['well'],
+                                                               row['sample'],
+                                                               pct_mica,
+                                                               pct_smectite)
+
+
+class MineralMatrix(object):
+    """A set of compiled MATERIALS (see compile_materials) stored as a
+       mineral x element matrix.
+
+       'fracs' holds each mineral's normalized atom fractions (one row per
+       mineral, one column per element of mcnpelements.ELEMENT_ORDER), and
+       'molar_masses' the corresponding mass of a mole of atoms, so that
+       mixing any number of formations is a couple of matrix products
+       instead of a loop over ElementalComposition dicts.
+    """
+    def __init__(self, library, minerals):
+        import numpy as np
+        self.minerals = tuple(minerals)
+        self.elements = el.ELEMENT_ORDER
+        self.fracs = el.compositions_to_array(
+            dict(library[mat][1]) for mat in self.minerals)
+        self.molar_masses = self.fracs.dot(el.ATOMIC_MASSES)
+        self.densities = np.array([library[mat][0]
+                                   for mat in self.minerals])
+
+    def mix(self, mass_fracs):
+        """Return (densities, element fractions) for an array of mixtures.
+
+           'mass_fracs' has shape (..., len(minerals)), and each mixture
+           should already sum to one. The element fractions come back with
+           shape (..., len(elements)) and sum to one.
+        """
+        import numpy as np
+        mass_fracs = np.asarray(mass_fracs, dtype=float)
+        density = 1.0/_sum_last(mass_fracs/self.densities)
+        mole_fracs = mass_fracs/self.molar_masses
+        elem_fracs = mole_fracs.dot(self.fracs)
+        elem_fracs /= elem_fracs.sum(axis=-1, keepdims=True)
+        return density, elem_fracs
+
+
+def _sum_last(a):
+    """Sum over the last axis strictly left to right, as sum() does in
+       get_card, so batched densities match it to the last bit."""
+    import numpy as np
+    return functools.reduce(np.add, np.moveaxis(a, -1, 0))
+
+
+def get_sweep(porosities=(0.0,), mica_pcts=(0.0,), smectite_pcts=(20.0,)):
+    """Return the (porosity, pct_mica, pct_smectite) sweep points,
+       in the same order as nested loops over the three arguments."""
+    return list(itertools.product(porosities, mica_pcts, smectite_pcts))
+
+
+# the sweep of a study
+POROSITIES = (20.0,)
+MICA_PCTS = (0,)
+SMECTITE_PCTS = (20,)
+
+
+# Inputs of the formation model, in the order of the last axis of the
+# arrays of get_input_mass_fracs and get_jacobian: the XRD weight percents
+# and the sweep point
+JACOBIAN_INPUTS = XRD_MINERALS + ('illite_mica', 'illite_smectite',
+                                  'porosity', 'pct_mica', 'pct_smectite')
+
+
+def get_input_mass_fracs(inputs):
+    """Return the MIX_MINERALS mass fractions for an array of
+       JACOBIAN_INPUTS, shape (..., inputs) -> (..., minerals).
+
+       This is the array form of the bookkeeping in get_card: the mica and
+       smectite percentages split illite_mica and illite_smectite into
+       muscovite, smectite and illite, the dry matrix is normalized to one,
+       and sandstone porosity is filled with water.
+    """
+    import numpy as np
+    inputs = np.asarray(inputs, dtype=float)
+    num_xrd = len(XRD_MINERALS)
+    xrd = inputs[..., :num_xrd]/100.0
+    xrd = np.where(xrd > 0, xrd, 0.0)
+    (illite_mica, illite_smectite,
+     v_w, mica_frac, smectite_frac) = np.moveaxis(inputs[..., num_xrd:],
+                                                  -1, 0)/100.0
+    clays = np.stack([illite_mica*mica_frac,
+                      illite_smectite*smectite_frac,
+                      illite_mica*(1 - mica_frac)
+                      + illite_smectite*(1 - smectite_frac)], axis=-1)
+    clays = np.where(clays > 0, clays, 0.0)
+    dry = np.concatenate([xrd, clays], axis=-1)
+    # dry matrix weight percentages might not quite sum to 1
+    dry /= _sum_last(dry)[..., np.newaxis]
+    # take care of the sandstone porosity
+    ss_frac = dry[..., XRD_MINERALS.index('sandstone')]
+    with np.errstate(divide='ignore'):
+        lam = np.where((ss_frac > 0) & (v_w > 0),
+                       (v_w/(1 - v_w))*(rho_w/rho_q)*ss_frac, 0.0)
+    rewt = 1.0/(1 + lam)
+    return np.concatenate([dry*rewt[..., np.newaxis],
+                           (lam*rewt)[..., np.newaxis]], axis=-1)
+
+
+def get_mass_fracs(mixdf, sweep):
+    """Return the MIX_MINERALS mass fractions for every row of 'mixdf' and
+       every point of 'sweep' (see get_sweep), shape (rows, points, minerals);
+       see get_input_mass_fracs.
+    """
+    import numpy as np
+    sweep = np.asarray(sweep, dtype=float).reshape(-1, 3)
+    num_columns = len(XRD_MINERALS) + 2
+    inputs = np.empty((len(mixdf), len(sweep), len(JACOBIAN_INPUTS)))
+    inputs[..., :num_columns] = mixdf.loc[
+        :, JACOBIAN_INPUTS[:num_columns]].to_numpy(dtype=float)[:, np.newaxis]
+    inputs[..., num_columns:] = sweep
+    return get_input_mass_fracs(inputs)
+
+
+def mix_formations(mixdf, sweep, matrix=None):
+    """Return (densities, element fractions) for every row of 'mixdf' and
+       every point of 'sweep', with shapes (rows, points) and
+       (rows, points, len(matrix.elements))."""
+    if matrix is None:
+        matrix = get_mineral_matrix()
+    return matrix.mix(get_mass_fracs(mixdf, sweep))
+
+
+def get_jacobian_inputs(mixdf, porosity=0.0, pct_mica=0.0, pct_smectite=20.0):
+    """Return the JACOBIAN_INPUTS of every row of 'mixdf', shape
+       (rows, inputs); the sweep values may be scalars or one per row."""
+    import numpy as np
+    inputs = np.empty((len(mixdf), len(JACOBIAN_INPUTS)))
+    num_columns = len(XRD_MINERALS) + 2
+    inputs[:, :num_columns] = mixdf.loc[
+        :, JACOBIAN_INPUTS[:num_columns]].to_numpy(dtype=float)
+    inputs[:, num_columns:] = np.stack(
+        np.broadcast_arrays(porosity, pct_mica, pct_smectite,
+                            np.zeros(len(mixdf)))[:3], axis=-1)
+    return inputs
+
+
+def get_jacobian(inputs, matrix=None):
+    """Return the formation density and element fractions of every row of
+       'inputs' (see get_jacobian_inputs), and their derivatives with
+       respect to each input: (density, elem_fracs, d_density, d_elem_fracs)
+       with shapes (...), (..., elements), (..., inputs) and
+       (..., elements, inputs).
+
+       The values are those of mix_formations; the derivatives follow the
+       same steps (clay split, normalization of the dry matrix, porosity
+       water, mixing) analytically, so a fit over many samples needs no
+       finite differences and no cards. Amounts clipped to zero, like
+       negative weight percents, have zero derivatives; at exactly zero
+       (e.g. pct_mica 0) the derivatives are those of an increase.
+    """
+    import numpy as np
+    if matrix is None:
+        matrix = get_mineral_matrix()
+    inputs = np.asarray(inputs, dtype=float)
+    shape = inputs.shape[:-1]
+    inputs = inputs.reshape(-1, len(JACOBIAN_INPUTS))
+    num, num_inputs = inputs.shape
+    num_xrd = len(XRD_MINERALS)
+    pct = inputs/100.0
+    xrd = pct[:, :num_xrd]
+    (illite_mica, illite_smectite,
+     v_w, mica_frac, smectite_frac) = pct[:, num_xrd:].T
+    # the dry matrix and its derivatives (per unit input, hence the 0.01s)
+    dry = np.empty((num, num_xrd + 3))
+    d_dry = np.zeros((num, num_xrd + 3, num_inputs))
+    dry[:, :num_xrd] = xrd
+    d_dry[:, np.arange(num_xrd), np.arange(num_xrd)] = 0.01
+    im, ism, por, mica, smectite = range(num_xrd, num_xrd + 5)
+    dry[:, num_xrd] = illite_mica*mica_frac
+    d_dry[:, num_xrd, im] = 0.01*mica_frac
+    d_dry[:, num_xrd, mica] = 0.01*illite_mica
+    dry[:, num_xrd + 1] = illite_smectite*smectite_frac
+    d_dry[:, num_xrd + 1, ism] = 0.01*smectite_frac
+    d_dry[:, num_xrd + 1, smectite] = 0.01*illite_smectite
+    dry[:, num_xrd + 2] = (illite_mica*(1 - mica_frac)
+                           + illite_smectite*(1 - smectite_frac))
+    d_dry[:, num_xrd + 2, im] = 0.01*(1 - mica_frac)
+    d_dry[:, num_xrd + 2, ism] = 0.01*(1 - smectite_frac)
+    d_dry[:, num_xrd + 2, mica] = -0.01*illite_mica
+    d_dry[:, num_xrd + 2, smectite] = -0.01*illite_smectite
+    d_dry[~(dry >= 0)] = 0.0
+    dry[~(dry > 0)] = 0.0
+    # normalized to one
+    total = _sum_last(dry)[:, np.newaxis]
+    dry /= total
+    d_dry = (d_dry - dry[..., np.newaxis]*d_dry.sum(axis=1, keepdims=True)
+             )/total[..., np.newaxis]
+    # sandstone porosity
+    sand = XRD_MINERALS.index('sandstone')
+    ss_frac = dry[:, sand]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scale = np.where(v_w > 0, (v_w/(1 - v_w))*(rho_w/rho_q), 0.0)
+        d_scale = np.where(v_w >= 0, 0.01*(rho_w/rho_q)/(1 - v_w)**2, 0.0)
+    lam = scale*ss_frac
+    d_lam = scale[:, np.newaxis]*d_dry[:, sand]
+    d_lam[:, por] += d_scale*ss_frac
+    rewt = 1.0/(1 + lam)
+    d_rewt = -(rewt**2)[:, np.newaxis]*d_lam
+    mass_fracs = np.concatenate([dry*rewt[:, np.newaxis],
+                                 (lam*rewt)[:, np.newaxis]], axis=-1)
+    d_mass_fracs = np.concatenate(
+        [d_dry*rewt[:, np.newaxis, np.newaxis]
+         + dry[..., np.newaxis]*d_rewt[:, np.newaxis, :],
+         ((rewt**2)[:, np.newaxis]*d_lam)[:, np.newaxis, :]], axis=1)
+    # mixing
+    density, elem_fracs = matrix.mix(mass_fracs)
+    d_density = -(density**2)[:, np.newaxis]*np.tensordot(
+        d_mass_fracs, 1.0/matrix.densities, axes=(1, 0))
+    per_mass = (matrix.fracs/matrix.molar_masses[:, np.newaxis]).T
+    total = mass_fracs.dot(per_mass.sum(axis=0))[:, np.newaxis, np.newaxis]
+    d_elem_fracs = np.matmul(per_mass, d_mass_fracs)
+    d_total = d_elem_fracs.sum(axis=1, keepdims=True)
+    d_elem_fracs -= elem_fracs[..., np.newaxis]*d_total
+    d_elem_fracs /= total
+    return (density.reshape(shape), elem_fracs.reshape(shape + (-1,)),
+            d_density.reshape(shape + (num_inputs,)),
+            d_elem_fracs.reshape(shape + d_elem_fracs.shape[1:]))
+
+
+def check_jacobian(inputs, step=1e-3, matrix=None):
+    """Return the largest difference between get_jacobian's derivatives
+       for 'inputs' and finite differences of get_input_mass_fracs and
+       mixing, relative to the largest derivative of each output. The
+       differences are central, except for inputs at zero, where (as in
+       get_jacobian) they are those of an increase, e.g. pct_mica or
+       porosity 0; both are second order in 'step'.
+
+       >>> inputs = [[60, 5, 5, 5, 5, 0, 2, 3, 5, 5, 3, 2, 0, 0, 20],
+       ...           [40, 9, 6, 0, 5, 1, 2, 0, 8, 7, 12, 10, 20, 30, 25]]
+       >>> check_jacobian(inputs) < 1e-6
+       True
+    """
+    import numpy as np
+    if matrix is None:
+        matrix = get_mineral_matrix()
+    inputs = np.asarray(inputs, dtype=float).reshape(-1, len(JACOBIAN_INPUTS))
+    density, elem_fracs, d_density, d_elem_fracs = get_jacobian(inputs,
+                                                                matrix)
+    num_d_density = np.empty_like(d_density)
+    num_d_elem_fracs = np.empty_like(d_elem_fracs)
+    for j in range(inputs.shape[-1]):
+        at_zero = inputs[:, j] == 0
+        # central: (f(x+h) - f(x-h))/2h; at zero: (-3f(x) + 4f(x+h)
+        # - f(x+2h))/2h
+        offsets = np.where(at_zero[:, np.newaxis], [0.0, 1.0, 2.0],
+                           [-1.0, 0.0, 1.0])
+        weights = np.where(at_zero[:, np.newaxis], [-3.0, 4.0, -1.0],
+                           [-1.0, 0.0, 1.0])/(2*step)
+        shifted = np.repeat(inputs[:, np.newaxis], 3, axis=1)
+        shifted[..., j] += step*offsets
+        densities, fracs = matrix.mix(get_input_mass_fracs(shifted))
+        num_d_density[:, j] = (weights*densities).sum(axis=1)
+        num_d_elem_fracs[..., j] = (weights[..., np.newaxis]*fracs).sum(axis=1)
+    return float(max(abs(d_density - num_d_density).max()
+                     / abs(d_density).max(),
+                     abs(d_elem_fracs - num_d_elem_fracs).max()
+                     / abs(d_elem_fracs).max()))
+
+
+def draw_xrd(inputs, num_draws, method='dirichlet', concentration=200.0,
+             sd=1.0, rng=None):
+    """Return 'num_draws' random variants of each row of 'inputs' (see
+       get_jacobian_inputs) for the lab uncertainty of its XRD weight
+       percents, shape (rows, draws, inputs); the sweep inputs are kept.
+
+       'dirichlet' draws the proportions of the minerals from a Dirichlet
+       distribution about the measured ones, whose 'concentration' sets
+       the spread (the variance of a proportion p is p(1 - p)/(c + 1)).
+       'gaussian' adds noise of 'sd' weight percent to each mineral,
+       clips at zero and scales back to the measured total. Minerals not
+       found stay at zero. 'rng' is a numpy Generator or a seed.
+    """
+    import numpy as np
+    rng = np.random.default_rng(rng)
+    inputs = np.asarray(inputs, dtype=float)
+    num_minerals = len(XRD_MINERALS) + 2
+    pct = np.where(inputs[:, :num_minerals] > 0, inputs[:, :num_minerals],
+                   0.0)[:, np.newaxis, :]
+    total = pct.sum(axis=-1, keepdims=True)
+    size = (len(inputs), num_draws, num_minerals)
+    if method == 'dirichlet':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            alpha = np.where(total > 0, concentration*pct/total, 0.0)
+        drawn = rng.standard_gamma(alpha, size=size)
+    elif method == 'gaussian':
+        drawn = pct + sd*rng.standard_normal(size)
+        drawn = np.where((pct > 0) & (drawn > 0), drawn, 0.0)
+    else:
+        raise ValueError("Unknown XRD uncertainty method %r" % method)
+    drawn_total = drawn.sum(axis=-1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        drawn = np.where(drawn_total > 0, drawn*(total/drawn_total), pct)
+    draws = np.empty(size[:2] + inputs.shape[-1:])
+    draws[...] = inputs[:, np.newaxis, :]
+    draws[..., :num_minerals] = drawn
+    return draws
+
+
+def xrd_ensemble(inputs, num_draws, quantiles=(0.05, 0.5, 0.95),
+                 max_formations=1 << 18, matrix=None, **draw_args):
+    """Propagate the XRD uncertainty of every row of 'inputs' into its
+       formation: mix 'num_draws' draw_xrd variants (with 'draw_args') of
+       each row and return the 'quantiles' of their densities and of
+       each element fraction, shapes (quantiles, rows) and (quantiles,
+       rows, elements). Rows are done in blocks of at most
+       'max_formations' draws in all, so memory stays bounded however
+       many rows and draws there are.
+    """
+    import numpy as np
+    if matrix is None:
+        matrix = get_mineral_matrix()
+    inputs = np.asarray(inputs, dtype=float)
+    rng = np.random.default_rng(draw_args.pop('rng', None))
+    density_q = np.empty((len(quantiles), len(inputs)))
+    elem_q = np.empty((len(quantiles), len(inputs), len(matrix.elements)))
+    block = max(1, max_formations//num_draws)
+    for start in range(0, len(inputs), block):
+        stop = min(start + block, len(inputs))
+        draws = draw_xrd(inputs[start:stop], num_draws, rng=rng, **draw_args)
+        density, elem_fracs = matrix.mix(get_input_mass_fracs(draws))
+        density_q[:, start:stop] = np.quantile(density, quantiles, axis=1)
+        elem_q[:, start:stop] = np.quantile(elem_fracs, quantiles, axis=1)
+        instrument.count('ensemble_formations', density.size)
+    return density_q, elem_q
+
+
+def get_quantile_cards(names, quantiles, density_q, elem_q,
+                       material_number=3):
+    """Return a material card for each name and quantile of xrd_ensemble
+       results, in name order. Each card pairs the density quantile with
+       the element fraction quantiles, renormalized to sum to one, so it
+       is a formation of typical (not jointly drawn) composition."""
+    elem_q = elem_q/elem_q.sum(axis=-1, keepdims=True)
+    card_names = ["%s, q%g" % (name, q) for name in names for q in quantiles]
+    return el.get_material_cards(
+        card_names, density_q.T.ravel().tolist(),
+        elem_q.transpose(1, 0, 2).reshape(-1, elem_q.shape[-1]),
+        material_number)
+
+
+def get_cards(mixdf, sweep, material_number=3):
+    """Batched get_card over a whole XRD table and sweep.
+
+       Yields (row, porosity, pct_mica, pct_smectite, density, name, card)
+       in row-major order, i.e. the order of the nested loops in main().
+       Each row is a dict of its column values, read from the columns in
+       one go rather than as a Series per row. Cards already in
+       CARD_CACHE are not made again.
+    """
+    with instrument.stage('mix'):
+        densities, elem_fracs = mix_formations(mixdf, sweep)
+    columns = list(mixdf.columns)
+    rows = [dict(zip(columns, values))
+            for values in zip(*[mixdf[col].tolist() for col in columns])]
+    points = [(row, porosity, pct_mica, pct_smectite)
+              for row in rows
+              for porosity, pct_mica, pct_smectite in sweep]
+    names = [get_name(row, pct_mica, pct_smectite)
+             for row, porosity, pct_mica, pct_smectite in points]
+    densities = densities.ravel().tolist()
+    elem_fracs = elem_fracs.reshape(-1, elem_fracs.shape[-1])
+    with instrument.stage('cards'):
+        keys = [(name, density, fracs.tobytes(), material_number)
+                for name, density, fracs in zip(names, densities, elem_fracs)]
+        cards = [CARD_CACHE.get(key) for key in keys]
+        missing = [n for n, card in enumerate(cards) if card is None]
+        new_cards = el.get_material_cards([names[n] for n in missing],
+                                          [densities[n] for n in missing],
+                                          elem_fracs[missing],
+                                          material_number)
+        for n, card in zip(missing, new_cards):
+            cards[n] = card
+            CARD_CACHE.put(keys[n], card)
+    instrument.count('cards', len(cards))
+    instrument.count('cards_cached', len(cards) - len(missing))
+    for point, density, name, card in zip(points, densities, names, cards):
+        yield point + (density, name, card)
+
+
+def get_mineral_matrix():
+    "Return the MineralMatrix of MIX_MINERALS, made on first use"
+    global _MINERAL_MATRIX
+    if _MINERAL_MATRIX is None:
+        _MINERAL_MATRIX = MineralMatrix(get_library(), MIX_MINERALS)
+    return _MINERAL_MATRIX
+
+
+# Column types of an XRD table, so that every block of a streamed table
+# comes back with the same dtypes
+XRD_DTYPES = dict([('well', str), ('sample', 'int64'), ('depth', str)]
+                  + [(col, 'float64') for col in XRD_MINERALS
+                     + ('total_clay', 'illite_mica', 'illite_smectite')])
+
+
+def _is_arrow(filename):
+    return os.path.splitext(filename)[1].lower() in ('.arrow', '.feather',
+                                                      '.ipc')
+
+
+def _is_parquet(filename):
+    return os.path.splitext(filename)[1].lower() in ('.parquet', '.pq')
+
+
+def read_xrd(filename, chunksize=None):
+    """Read an XRD table from a csv, Parquet or Arrow IPC file.
+
+       Without a 'chunksize' the whole table is returned as a DataFrame.
+       With one, an iterator over DataFrames of (at most) 'chunksize' rows
+       is returned, so that tables of any size can be streamed through
+       generate. Arrow IPC batches larger than 'chunksize' are sliced,
+       without copying. Parquet and Arrow files need pyarrow.
+    """
+    import pandas as pd
+    if _is_parquet(filename) or _is_arrow(filename):
+        chunks = _read_arrow_chunks(filename, chunksize)
+        if chunksize is None:
+            return pd.concat(list(chunks), ignore_index=True)
+        return chunks
+    dtypes = dict((col, dtype) for col, dtype in XRD_DTYPES.items()
+                  if col in pd.read_csv(filename, nrows=0).columns)
+    return pd.read_csv(filename, dtype=dtypes, chunksize=chunksize)
+
+
+def _read_arrow_chunks(filename, chunksize):
+    import pyarrow
+    import pyarrow.parquet
+    if _is_parquet(filename):
+        batches = pyarrow.parquet.ParquetFile(filename).iter_batches(
+            batch_size=chunksize or 65536)
+    else:
+        reader = pyarrow.ipc.open_file(filename)
+        batches = (reader.get_batch(i)
+                   for i in range(reader.num_record_batches))
+        if chunksize:
+            batches = (batch.slice(offset, chunksize) for batch in batches
+                       for offset in range(0, batch.num_rows, chunksize))
+    for batch in batches:
+        chunk = batch.to_pandas()
+        yield chunk.astype(dict((col, dtype)
+                                for col, dtype in XRD_DTYPES.items()
+                                if col in chunk.columns))
+
+
+def count_xrd_rows(filename):
+    """Return the number of rows read_xrd reads from an XRD table, without
+       loading it"""
+    if _is_parquet(filename):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetFile(filename).metadata.num_rows
+    if _is_arrow(filename):
+        import pyarrow
+        return pyarrow.ipc.open_file(filename).count_rows()
+    # read just the first column, a block at a time, so that blank lines
+    # and quoted line breaks count exactly as they do for read_xrd
+    import pandas as pd
+    return sum(len(chunk) for chunk in pd.read_csv(filename, usecols=[0],
+                                                   chunksize=1 << 16))
+
+
+def get_submit_entry(filename, mctal=False):
+    """Return the mcnprun lines that queue deck 'filename'; with 'mctal',
+       the run also writes its tallies to a mctal file '<filename>mc'"""
+    return ('Log = %s.log\n' % filename
+            + 'Output = %s.out\n' % filename
+            + 'Error = %s.err\n' % filename
+            + 'Arguments = inp=%sin wwinp=ctn8ww ou=%sou ru=%sta' % (filename,
+                                                                     filename,
+                                                                     filename)
+            + (' mctal=%smc\n' % filename if mctal else '\n')
+            + 'transfer_input_files = %sin, ctn8ww\n' % filename
+            + 'queue\n\n')
+
+
+def request_mctal(template):
+    """Return deck template text 'template' with its PRDMP card's third
+       entry set to 1, so that MCNP writes a mctal file"""
+    lines = template.split('\n')
+    for i, line in enumerate(lines):
+        card, sep, comment = line.partition('$')
+        words = card.split()
+        if not words or words[0].lower() != 'prdmp':
+            continue
+        entries = []
+        for word in words[1:]:
+            m = re.match(r'^(\d*)j$', word, re.IGNORECASE)
+            entries += ['j']*int(m.group(1) or 1) if m else [word]
+        entries += ['j']*(3 - len(entries))
+        entries[2] = '1'
+        lines[i] = ' '.join([words[0]] + entries) + (' $' + comment
+                                                      if sep else '')
+        return '\n'.join(lines)
+    raise ValueError("The deck template has no PRDMP card")
+
+
+MANIFEST_COLUMNS = ('filename', 'rand_seed', 'well', 'sample', 'porosity',
+                    'pct_mica', 'pct_smectite', 'formation_density', 'hash',
+                    'formation', 'archive', 'offset', 'size')
+# XRD.csv columns that go into a deck
+XRD_COLUMNS = ('well', 'sample') + XRD_MINERALS + ('illite_mica',
+                                                  'illite_smectite')
+
+
+def get_formation_hash(deck_template, row, porosity, pct_mica, pct_smectite,
+                       formation_density, formation_card):
+    """Return a hashlib object fed with everything a formation's decks
+       depend on: the template, the XRD row, the sweep point, and the
+       resulting density and material card (which carry the data of the
+       minerals actually used). Each deck adds its file name and seed."""
+    h = hashlib.sha256(deck_template.digest.encode('ascii'))
+    for value in ([row[col] for col in XRD_COLUMNS]
+                  + [porosity, pct_mica, pct_smectite, formation_density,
+                     formation_card]):
+        h.update(b'\0' + str(value).encode('utf-8'))
+    return h
+
+
+def get_formation_key(deck_template, formation_density, formation_card):
+    """Return the key of a formation in a results.ResultsStore: a hash of
+       the template, the density and the material card without its
+       comment lines, so it doesn't depend on the formation's name, the
+       XRD row or the sweep point, only on what MCNP actually sees."""
+    card = '\n'.join(line for line in formation_card.splitlines()
+                     if not line.lower().startswith('c'))
+    h = hashlib.sha256(deck_template.digest.encode('ascii'))
+    for value in (formation_density, card):
+        h.update(b'\0' + str(value).encode('utf-8'))
+    return h.hexdigest()
+
+
+def get_item_entry(filename):
+    "Return the itemdata line that queues deck 'filename'"
+    return '%s\n' % filename
+
+
+def get_submit_description(itemfile, pack_size=1, mctal=False,
+                           archive=False):
+    """Return a submit description that queues every deck (or with a
+       'pack_size' > 1, every pack of decks written by PackWriter) listed
+       in 'itemfile', instead of a block of lines per deck. With 'mctal',
+       the runs also write mctal files (see get_submit_entry). With
+       'archive', the packs are write_decks archives, and each job is
+       sent the archive's index (see get_index_name) so that runpack.py
+       reads its decks by offset."""
+    if pack_size > 1:
+        index = '$(pack).index.csv' if archive else ''
+        return (submit_header.replace('Executable = mcnp611.sh',
+                                      'Executable = runpack.py')
+                + '\n'
+                + 'Log = $(pack).log\n'
+                + 'Output = $(pack).out\n'
+                + 'Error = $(pack).err\n'
+                + 'Arguments = --archive $(pack).tar --mcnp mcnp611.sh '
+                  '--wwinp ctn8ww %s%s$(decks)\n'
+                  % ('--index %s ' % index if archive else '',
+                     '--mctal ' if mctal else '')
+                + 'transfer_input_files = $(pack).tar, %sctn8ww, mcnp611.sh\n'
+                  % ('%s, ' % index if archive else '')
+                + 'queue pack, decks from %s\n' % itemfile)
+    return (submit_header
+            + '\n'
+            + 'Log = $(deck).log\n'
+            + 'Output = $(deck).out\n'
+            + 'Error = $(deck).err\n'
+            + 'Arguments = inp=$(deck)in wwinp=ctn8ww ou=$(deck)ou ru=$(deck)ta'
+            + (' mctal=$(deck)mc\n' if mctal else '\n')
+            + 'transfer_input_files = $(deck)in, ctn8ww\n'
+            + 'queue deck from %s\n' % itemfile)
+
+
+def get_index_name(pack):
+    """Return the name of the index of pack 'pack''s write_decks archive:
+       the archive's manifest records, which runpack.read_index reads"""
+    return '%s.index.csv' % pack
+
+
+def get_pack_name(first_deck):
+    return '%sp' % first_deck
+
+
+class PackWriter(object):
+    """Sink for get_item_entry lines that groups decks into packs.
+
+       Every 'pack_size' decks written to it are put in a tar archive named
+       after the first of them (see get_pack_name), and a 'pack deck deck
+       ...' itemdata line is written to 'itemfp', for the submit
+       description of get_submit_description to run with runpack.py.
+       close() writes the last, possibly smaller, pack.
+    """
+    def __init__(self, itemfp, pack_size):
+        self.itemfp = itemfp
+        self.pack_size = pack_size
+        self.decks = []
+
+    def write(self, entries):
+        for filename in entries.split():
+            self.decks.append(filename)
+            if len(self.decks) == self.pack_size:
+                self._write_pack()
+
+    def _write_pack(self):
+        pack = get_pack_name(self.decks[0])
+        archive = tarfile.open('%s.tar' % pack, 'w')
+        for filename in self.decks:
+            archive.add('%sin' % filename)
+        archive.close()
+        self.itemfp.write(' '.join([pack] + self.decks) + '\n')
+        self.decks = []
+
+    def close(self):
+        if self.decks:
+            self._write_pack()
+
+
+class DeckArchive(object):
+    """Tar archive that decks are written into instead of separate files.
+
+       The archive is written through a large buffer and only appears
+       under its name once closed. With 'compress', each deck is stored
+       gzipped as its own '<name>.gz' member, so that any one deck can
+       still be read from its offset without reading the others.
+    """
+    def __init__(self, filename, compress=False, bufsize=1 << 20):
+        self.filename = filename
+        self.compress = compress
+        self.mtime = time.time()
+        self._fp = open(filename + '.tmp', 'wb', buffering=bufsize)
+        self._tar = tarfile.open(fileobj=self._fp, mode='w',
+                                 format=tarfile.USTAR_FORMAT)
+
+    def add(self, name, data):
+        "Add file 'name' holding 'data'; return its data's (offset, size)"
+        if self.compress:
+            name += '.gz'
+            data = gzip.compress(data, mtime=0)
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self.mtime
+        self._tar.addfile(info, io.BytesIO(data))
+        padded = -(-len(data)//tarfile.BLOCKSIZE)*tarfile.BLOCKSIZE
+        return self._tar.offset - padded, len(data)
+
+    def close(self):
+        self._tar.close()
+        self._fp.close()
+        os.replace(self.filename + '.tmp', self.filename)
+
+
+def write_decks(deck_template, mixdf, sweep, num_repeats, seeds,
+                first_filenum=1, date=None, filename_format="s%05d",
+                written=None, submitted=None, submit_entry=get_submit_entry,
+                archive=False, compress=False, store=None,
+                target_relerr=None):
+    """Write 'num_repeats' decks for every row of 'mixdf' and sweep point.
+
+       'seeds' holds one random seed per deck, in the order the decks are
+       written, and the decks are numbered from 'first_filenum'. Returns
+       the mcnprun entries for the decks written and their manifest
+       records (see MANIFEST_COLUMNS), so that blocks of rows can be
+       written in any order (or in parallel, see generate) and still be
+       collected in sweep order.
+
+       'written' and 'submitted' map file names to the hashes of decks
+       already on disk and already in a submit file. A deck whose hash is
+       unchanged is not written again, and gets no mcnprun entry if it
+       was already submitted. 'submit_entry' returns the entry for a deck
+       (get_submit_entry, or get_item_entry for an itemdata list).
+
+       With 'archive', the decks go into one DeckArchive (optionally
+       compressed) named after the pack of the first deck, the manifest
+       records give each deck's offset and size in it (and are also
+       written to the archive's index, see get_index_name), and the entries
+       are a single PackWriter-style itemdata line for the decks to run.
+       The archive is always rewritten whole, so 'written' is not used.
+
+       'store' names a results.ResultsStore; formations that already have
+       'num_repeats' good runs in it, or with a 'target_relerr', whose
+       combined estimate is at least that good, get no decks (and no
+       manifest records), though their file numbers stay reserved, and
+       neither do decks whose formation and seed are already stored, so a
+       repeated study never redoes a run.
+    """
+    if date is None:
+        date = str(datetime.date.today())
+    if written is None:
+        written = {}
+    if submitted is None:
+        submitted = {}
+    seeds = iter(seeds)
+    filenum = first_filenum
+    entries = []
+    records = []
+    if archive:
+        pack = get_pack_name(filename_format % first_filenum)
+        archive = DeckArchive('%s.tar' % pack, compress)
+        pack_decks = []
+    if store is not None:
+        store = results.ResultsStore(store)
+    for (row, porosity, pct_mica, pct_smectite,
+         formation_density, formation, formation_card) in get_cards(mixdf, sweep):
+        formation_key = get_formation_key(deck_template, formation_density,
+                                          formation_card)
+        if store is not None and store.is_done(formation_key, num_repeats,
+                                               target_relerr):
             for repeat in range(num_repeats):
-                d = {}
-                d['date'] = str(datetime.date.today())
-                filename = "s%05d" % filenum
-                d['filename'] = "%sin" % filename
-                d['formation'] = formation
-                d['formation_card'] = formation_card
-                d['formation_density'] = formation_density
-                d['porosity'] = porosity
-                d['pct_mica'] = pct_mica
-                d['pct_smectite'] = pct_smectite
-                d['rand_seed'] = get_random_seed()
-                new_deck = deck_template.substitute(d)
-                outfile = open('%sin' % filename, 'w')
-                outfile.write(new_deck)
-                outfile.close()
-                runfp.write('Log = %s.log\n' % filename)
-                runfp.write('Output = %s.out\n' % filename)
-                runfp.write('Error = %s.err\n' % filename)
-                runfp.write('Arguments = inp=%sin wwinp=ctn8ww ou=%sou ru=%sta\n' % (filename,
-                                                                                    filename,
-                                                                                    filename))
-                runfp.write('transfer_input_files = %sin, ctn8ww\n' % filename)
-                runfp.write('queue\n\n')
+                next(seeds)
+            filenum += num_repeats
+            instrument.count('formations_done')
+            continue
+        formation_hash = get_formation_hash(deck_template, row, porosity,
+                                            pct_mica, pct_smectite,
+                                            formation_density, formation_card)
+        formation_template = None
+        for repeat in range(num_repeats):
+            d = {}
+            filename = filename_format % filenum
+            d['filename'] = "%sin" % filename
+            d['rand_seed'] = next(seeds)
+            if store is not None and store.has_run(formation_key,
+                                                   d['rand_seed']):
+                instrument.count('decks_already_run')
                 filenum += 1
+                continue
+            h = formation_hash.copy()
+            h.update(('\0%s\0%s' % (filename, d['rand_seed'])).encode('ascii'))
+            deck_hash = h.hexdigest()
+            location = ('', '', '')
+            if (archive or written.get(filename) != deck_hash
+                    or not os.path.exists('%sin' % filename)):
+                with instrument.stage('render'):
+                    if formation_template is None:
+                        formation_template = deck_template.bind(
+                            {'date': date,
+                             'formation': formation,
+                             'formation_card': formation_card,
+                             'formation_density': formation_density,
+                             'porosity': porosity,
+                             'pct_mica': pct_mica,
+                             'pct_smectite': pct_smectite})
+                    new_deck = formation_template.render(d)
+                with instrument.stage('write'):
+                    if archive:
+                        location = (archive.filename,) + archive.add(
+                            '%sin' % filename, new_deck)
+                    else:
+                        outfile = open('%sin' % filename, 'wb')
+                        outfile.write(new_deck)
+                        outfile.close()
+                instrument.count('decks_written')
+                instrument.count('deck_bytes', len(new_deck))
+            instrument.count('decks')
+            if submitted.get(filename) != deck_hash:
+                if archive:
+                    pack_decks.append(filename)
+                else:
+                    entries.append(submit_entry(filename))
+            records.append((filename, d['rand_seed'], row['well'],
+                            row['sample'], porosity, pct_mica, pct_smectite,
+                            formation_density, deck_hash, formation_key)
+                           + location)
+            filenum += 1
+    if store is not None:
+        store.close()
+    if archive:
+        with instrument.stage('write'):
+            archive.close()
+            indexfile = get_index_name(pack)
+            fp = open(indexfile + '.tmp', 'w', newline='')
+            writer = csv.writer(fp)
+            writer.writerow(MANIFEST_COLUMNS)
+            writer.writerows(records)
+            fp.close()
+            os.replace(indexfile + '.tmp', indexfile)
+        instrument.count('archives')
+        if pack_decks:
+            entries.append(' '.join([pack] + pack_decks) + '\n')
+    return ''.join(entries), records
+
+
+def get_filename_format(first_filenum, num_decks):
+    """Return the format of the deck names of a study of 'num_decks' decks
+       numbered from 'first_filenum': at least five digits, and as many
+       as the last deck needs
+
+       >>> get_filename_format(99990, 20) % 99990
+       's099990'
+    """
+    digits = max(5, len(str(first_filenum - 1 + num_decks)))
+    return "s%%0%dd" % digits
+
+
+def get_next_deck(store=None, manifestfile=None):
+    """Return the number to give the first deck of a study that follows on
+       from the decks of results store 'store' and manifest 'manifestfile'
+       (either may be None or not exist yet): one after the last of them.
+       Studies with the same study seed and no overlap in deck numbers
+       never repeat a seed."""
+    last = 0
+    if store is not None and os.path.exists(store):
+        store = results.ResultsStore(store)
+        try:
+            last = store.last_deck()
+        finally:
+            store.close()
+    if manifestfile is not None:
+        last = max(last, results.get_last_deck(manifestfile))
+    return last + 1
+
+
+def _write_decks(args):
+    # also returns the stats of the task, which may run in a pool process
+    with instrument.collect() as stats:
+        result = write_decks(*args)
+    return result, stats.snapshot()
+
+
+def get_shard_rows(num_rows, shard=0, num_shards=1):
+    "Return the (start, stop) rows of shard 'shard' of 'num_shards'"
+    if not 0 <= shard < num_shards:
+        raise ValueError("Invalid shard {0:d} of {1:d}".format(shard,
+                                                              num_shards))
+    return shard*num_rows//num_shards, (shard + 1)*num_rows//num_shards
+
+
+def get_shard_filename(filename, shard, num_shards):
+    return "%s.%03d-of-%03d" % (filename, shard, num_shards)
+
+
+def _subset(hashes, filenames):
+    # only ship each task the manifest entries for its own decks
+    if not hashes:
+        return None
+    return dict((filename, hashes[filename]) for filename in filenames
+                if filename in hashes)
+
+
+def read_manifest(manifestfile):
+    """Return a dict of file name -> deck hash from a manifest written by
+       generate, or an empty dict if there is none. Later lines win, so an
+       interrupted run's journal can simply be appended to."""
+    hashes = {}
+    if not os.path.exists(manifestfile):
+        return hashes
+    fp = open(manifestfile, newline='')
+    reader = csv.reader(fp)
+    column = MANIFEST_COLUMNS.index('hash')
+    for record in reader:
+        if record and record[0] != MANIFEST_COLUMNS[0] and len(record) > column:
+            hashes[record[0]] = record[column]
+    fp.close()
+    return hashes
+
+
+def finish_manifest(journalfile, manifestfile, header=True):
+    """Replace 'manifestfile' by the last record of each deck in the
+       journal of a completed run, and remove the journal."""
+    fp = open(journalfile, newline='')
+    records = dict((record[0], record) for record in csv.reader(fp)
+                   if record and record[0] != MANIFEST_COLUMNS[0])
+    fp.close()
+    tmpfile = manifestfile + '.tmp'
+    fp = open(tmpfile, 'w', newline='')
+    writer = csv.writer(fp)
+    if header:
+        writer.writerow(MANIFEST_COLUMNS)
+    writer.writerows(records[filename] for filename in sorted(records))
+    fp.close()
+    os.replace(tmpfile, manifestfile)
+    os.remove(journalfile)
+
+
+def generate(deck_template, mixdf, sweep, num_repeats, runfp,
+             workers=1, rows_per_task=None, manifestfp=None,
+             study_seed=None, shard=0, num_shards=1,
+             written=None, submitted=None, num_rows=None,
+             submit_entry=get_submit_entry, archive_size=None,
+             compress=False, store=None, target_relerr=None,
+             first_filenum=1):
+    """Write the decks for a whole sweep and their entries to 'runfp'.
+
+       The file numbers, random seeds and date of every deck are decided
+       here, in sweep order, and the rows of 'mixdf' are then split into
+       blocks of 'rows_per_task' rows that are written by a pool of
+       'workers' processes. The output is the same as a serial run
+       (workers=1) that draws the same seeds. If 'manifestfp' is given,
+       a csv line per deck (MANIFEST_COLUMNS) is written to it.
+
+       'mixdf' may also be an iterator over blocks of the XRD table (see
+       read_xrd), in which case 'num_rows' must give the total number of
+       rows. Only a few blocks are held in memory at a time, however
+       large the table is.
+
+       With a 'study_seed', seeds come from get_deck_seed instead of the
+       random module, so they are reproducible. The sweep can then also
+       be split into 'num_shards' slices of rows, of which this call
+       writes slice 'shard'; file numbers are global across shards, with
+       enough digits for the whole study, and merge_shards puts the
+       shards' submit files and manifests back together.
+
+       'written' and 'submitted' (see write_decks and read_manifest) make
+       the run incremental: only decks whose inputs changed are written,
+       and only those not already submitted go into 'runfp'.
+       'submit_entry' is passed on to write_decks.
+
+       With an 'archive_size', each task writes its decks into one
+       DeckArchive of (about) that many decks, instead of one file per
+       deck; see write_decks. The archives, like the file numbers, don't
+       depend on the number of workers.
+
+       'store' (see write_decks) skips the formations that already have
+       'num_repeats' good runs in that results store, or that meet
+       'target_relerr'. Decks are numbered from 'first_filenum', so that
+       later rounds of runs (see adaptive.py) get new names and seeds.
+    """
+    import pandas as pd
+    if num_shards > 1 and study_seed is None:
+        raise ValueError("Sharded generation needs a study seed")
+    if isinstance(mixdf, pd.DataFrame):
+        num_rows = len(mixdf)
+        chunks = [mixdf]
+    elif num_rows is None:
+        raise ValueError("Streaming generation needs the number of rows")
+    else:
+        chunks = mixdf
+    decks_per_row = len(sweep)*num_repeats
+    row_start, row_stop = get_shard_rows(num_rows, shard, num_shards)
+    filename_format = get_filename_format(first_filenum,
+                                          num_rows*decks_per_row)
+    date = str(datetime.date.today())
+    if archive_size:
+        rows_per_task = max(1, -(-archive_size//decks_per_row))
+    elif rows_per_task is None:
+        # a few tasks per worker to even out the load
+        rows_per_task = max(1, -(-(row_stop - row_start)//(4*workers)))
+
+    def get_tasks():
+        chunk_start = 0
+        for chunk in chunks:
+            chunk_stop = chunk_start + len(chunk)
+            for start in range(max(row_start, chunk_start),
+                               min(row_stop, chunk_stop), rows_per_task):
+                stop = min(start + rows_per_task, row_stop, chunk_stop)
+                first = first_filenum + start*decks_per_row
+                filenums = range(first, first_filenum + stop*decks_per_row)
+                if study_seed is None:
+                    seeds = [get_random_seed() for filenum in filenums]
+                else:
+                    seeds = [get_deck_seed(filenum, study_seed)
+                             for filenum in filenums]
+                filenames = [filename_format % filenum for filenum in filenums]
+                yield (deck_template,
+                       chunk.iloc[start - chunk_start:stop - chunk_start],
+                       sweep, num_repeats, seeds, first, date,
+                       filename_format, _subset(written, filenames),
+                       _subset(submitted, filenames), submit_entry,
+                       bool(archive_size), compress, store, target_relerr)
+            chunk_start = chunk_stop
+            if chunk_start >= row_stop:
+                break
+
+    writer = csv.writer(manifestfp) if manifestfp is not None else None
+    if writer is not None and shard == 0:
+        writer.writerow(MANIFEST_COLUMNS)
+
+    def write(result):
+        (entries, records), stats = result
+        instrument.merge(stats)
+        with instrument.stage('submit'):
+            runfp.write(entries)
+            if writer is not None:
+                writer.writerows(records)
+        instrument.count('submit_bytes', len(entries))
+
+    if workers > 1:
+        # keep only a couple of tasks per worker in flight, so that
+        # neither the input blocks nor the results pile up in memory
+        pool = multiprocessing.Pool(workers)
+        pending = collections.deque()
+        try:
+            for task in instrument.timed_iter('tasks', get_tasks()):
+                pending.append(pool.apply_async(_write_decks, (task,)))
+                if len(pending) >= 2*workers:
+                    write(pending.popleft().get())
+            while pending:
+                write(pending.popleft().get())
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in instrument.timed_iter('tasks', get_tasks()):
+            write(_write_decks(task))
+
+
+def merge_shards(num_shards, runfp, manifestfp,
+                 runfile="mcnprun", manifestfile="manifest.csv"):
+    """Concatenate the submit files and manifests written by the
+       'num_shards' shards of a study into 'runfp' and 'manifestfp'.
+
+       Checks that every shard is present and that no two decks share a
+       file name or random seed.
+    """
+    filenames = set()
+    seeds = set()
+    for shard in range(num_shards):
+        fp = open(get_shard_filename(manifestfile, shard, num_shards),
+                  newline='')
+        lines = fp.readlines()
+        fp.close()
+        for record in csv.reader(lines[1 if shard == 0 else 0:]):
+            if record[0] in filenames or record[1] in seeds:
+                raise ValueError("Deck {0} of shard {1:d} duplicates an "
+                                 "earlier file name or seed".format(record[0],
+                                                                    shard))
+            filenames.add(record[0])
+            seeds.add(record[1])
+        manifestfp.writelines(lines)
+        fp = open(get_shard_filename(runfile, shard, num_shards))
+        runfp.write(fp.read())
+        fp.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Construct MCNP input decks and the mcnprun submit "
+                    "file for the cuttings in XRD.csv")
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help="number of processes writing decks")
+    parser.add_argument('--study-seed', type=int,
+                        help="derive reproducible random seeds from this "
+                             "number instead of drawing them at random")
+    parser.add_argument('--shard', type=int, default=0,
+                        help="which slice of the sweep to generate")
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help="number of slices the sweep is split into; "
+                             "each shard writes its own mcnprun and "
+                             "manifest.csv, suffixed with the shard number")
+    parser.add_argument('--merge', action='store_true',
+                        help="merge the submit files and manifests of all "
+                             "--num-shards shards instead of generating")
+    parser.add_argument('-i', '--input', default='XRD.csv',
+                        help="XRD table (csv, Parquet or Arrow IPC)")
+    parser.add_argument('--chunksize', type=int,
+                        help="stream the XRD table in blocks of this many "
+                             "rows instead of loading it all at once")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only write decks whose inputs changed since "
+                             "the last run (per the manifest), resume an "
+                             "interrupted run, and only submit new or "
+                             "changed decks")
+    parser.add_argument('--itemdata', action='store_true',
+                        help="write mcnprun as one submit description that "
+                             "queues the decks listed in mcnprun.items")
+    parser.add_argument('--pack', type=int, default=1,
+                        help="run this many decks per job with runpack.py, "
+                             "from one tar archive per job (implies "
+                             "--itemdata)")
+    parser.add_argument('--archive-size', type=int,
+                        help="write the decks into tar archives of about "
+                             "this many decks instead of one file each, "
+                             "and run each archive as a pack of jobs")
+    parser.add_argument('--compress', action='store_true',
+                        help="gzip each deck in the archives")
+    parser.add_argument('--mctal', action='store_true',
+                        help="have MCNP write a mctal file of the tallies "
+                             "for each deck (<deck>mc), which ouextract.py "
+                             "reads instead of the output file")
+    parser.add_argument('--store',
+                        help="results store (see ouextract.py --store); "
+                             "formations that already have enough runs "
+                             "there that passed the statistical checks "
+                             "get no decks")
+    parser.add_argument('--target-relerr', type=float,
+                        help="with --store, skip the formations whose "
+                             "combined tally relative error is already "
+                             "this small instead")
+    parser.add_argument('--repeats', type=int, default=10,
+                        help="number of runs (decks) per formation")
+    parser.add_argument('--first-deck', type=int, default=1,
+                        help="number of the first deck")
+    parser.add_argument('--report', default='getdecks-report.json',
+                        help="JSON file for the run's stage timings and "
+                             "counters ('' for none)")
+    parser.add_argument('--profile',
+                        help="write cProfile stats of the main process here")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="report the peak memory traced by tracemalloc")
+    args = parser.parse_args(args)
+    with instrument.session(args.report, args.profile, args.trace_memory,
+                            'getdecks'):
+        run(args)
+
+
+def run(args):
+    "Carry out a getdecks.py run for the parsed command line 'args'"
+    runfile = "mcnprun"
+    itemfile = runfile + '.items'
+    manifestfile = "manifest.csv"
+    if args.archive_size:
+        # an archive's decks run as one pack
+        args.pack = max(args.pack, 2)
+    itemdata = args.itemdata or args.pack > 1
+    if args.num_shards > 1 or args.incremental:
+        if args.study_seed is None:
+            args.study_seed = 0
+
+    if args.merge:
+        runfp = open(runfile, 'w')
+        if itemdata:
+            runfp.write(get_submit_description(itemfile, args.pack,
+                                               args.mctal,
+                                               bool(args.archive_size)))
+            runfp.close()
+            runfile = itemfile
+            runfp = open(runfile, 'w')
+        else:
+            runfp.write(submit_header)
+            runfp.write('\n')
+        manifestfp = open(manifestfile, 'w', newline='')
+        merge_shards(args.num_shards, runfp, manifestfp,
+                     runfile, manifestfile)
+        manifestfp.close()
+        runfp.close()
+        return
+
+    with instrument.stage('template'):
+        fp = open("ctn8tmpl")
+        deck_template = fp.read()
+        fp.close()
+        if args.mctal:
+            deck_template = request_mctal(deck_template)
+        deck_template = DeckTemplate(deck_template)
+
+    if itemdata:
+        if args.num_shards == 1:
+            fp = open(runfile, 'w')
+            fp.write(get_submit_description(itemfile, args.pack, args.mctal,
+                                            bool(args.archive_size)))
+            fp.close()
+        runfile = itemfile
+    if args.num_shards > 1:
+        runfile = get_shard_filename(runfile, args.shard, args.num_shards)
+        manifestfile = get_shard_filename(manifestfile, args.shard,
+                                          args.num_shards)
+    runfp = open(runfile, 'w')
+    if args.num_shards == 1 and not itemdata:
+        runfp.write(submit_header)
+        runfp.write('\n')
+    if itemdata:
+        submit_entry = get_item_entry
+    else:
+        submit_entry = functools.partial(get_submit_entry, mctal=args.mctal)
+    if args.pack > 1 and not args.archive_size:
+        sink = PackWriter(runfp, args.pack)
+    else:
+        sink = runfp
+    written = submitted = None
+    if args.incremental:
+        # decks are journaled as they are written; a journal left behind
+        # by an interrupted run records decks that are on disk but were
+        # never submitted
+        journalfile = manifestfile + '.partial'
+        submitted = read_manifest(manifestfile)
+        written = dict(submitted)
+        written.update(read_manifest(journalfile))
+        manifestfp = open(journalfile, 'a', newline='')
+    else:
+        manifestfp = open(manifestfile, 'w', newline='')
+
+    if args.chunksize or _is_arrow(args.input):
+        num_rows = count_xrd_rows(args.input)
+        mixdf = read_xrd(args.input, args.chunksize)
+    else:
+        num_rows = None
+        with instrument.stage('read_xrd'):
+            mixdf = read_xrd(args.input)
+
+    num_repeats = args.repeats
+    sweep = get_sweep(POROSITIES, MICA_PCTS, SMECTITE_PCTS)
+    generate(deck_template, mixdf, sweep, num_repeats, sink, args.workers,
+             manifestfp=manifestfp, study_seed=args.study_seed,
+             shard=args.shard, num_shards=args.num_shards,
+             written=written, submitted=submitted, num_rows=num_rows,
+             submit_entry=submit_entry, archive_size=args.archive_size,
+             compress=args.compress, store=args.store,
+             target_relerr=args.target_relerr, first_filenum=args.first_deck)
+    sink.close()
+    manifestfp.close()
+    if sink is not runfp:
+        runfp.close()
+    if args.incremental:
+        finish_manifest(journalfile, manifestfile, header=args.shard == 0)
+
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Per-stage timers and counters for getdecks.py and ouextract.py runs.
+
+   Code marks its stages with 'with stage(name):' and its throughput with
+   count(name, n); both go to the module-level STATS. Work done in pool
+   processes is gathered with collect() and merged back into the parent's
+   STATS, so stage times are summed over all processes. session() wraps a
+   whole run, optionally under cProfile and tracemalloc, and writes a JSON
+   report with the stage times, counters and their rates at the end.
+"""
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import socket
+import sys
+import time
+import tracemalloc
+
+
+class Instruments(object):
+    """Accumulated seconds and calls per stage, and named counters"""
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.counters = collections.defaultdict(int)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def snapshot(self):
+        "Return the stages and counters as plain (picklable) dicts"
+        return {'stages': dict((name, {'seconds': self.seconds[name],
+                                       'calls': self.calls[name]})
+                               for name in self.seconds),
+                'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        "Add a snapshot (e.g. from a pool process) to these totals"
+        for name, stage in snapshot['stages'].items():
+            self.seconds[name] += stage['seconds']
+            self.calls[name] += stage['calls']
+        for name, n in snapshot['counters'].items():
+            self.counters[name] += n
+
+
+STATS = Instruments()
+
+
+def stage(name):
+    "Context manager timing stage 'name' in STATS"
+    return STATS.stage(name)
+
+
+def count(name, n=1):
+    STATS.count(name, n)
+
+
+def timed_iter(name, iterable):
+    "Yield from 'iterable', timing each step as stage 'name'"
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+@contextlib.contextmanager
+def collect():
+    """Gather the stats of a block of work in a fresh Instruments.
+
+       Use it around the work a pool process does for one task and send
+       the snapshot back with the result, for the parent to merge().
+    """
+    global STATS
+    saved = STATS
+    STATS = Instruments()
+    try:
+        yield STATS
+    finally:
+        STATS = saved
+
+
+def merge(snapshot):
+    STATS.merge(snapshot)
+
+
+@contextlib.contextmanager
+def session(report=None, profile=None, trace_memory=False, program=None):
+    """Instrument a whole run.
+
+       On exit, writes a JSON report to 'report' (if given) with the wall
+       time, the STATS stages and counters, and each counter's rate per
+       second of wall time. 'profile' names a file for cProfile stats of
+       this process, and with 'trace_memory' the report includes the peak
+       memory traced in this process.
+    """
+    start = time.time()
+    wall = time.perf_counter()
+    profiler = cProfile.Profile() if profile else None
+    if trace_memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield STATS
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile)
+        elapsed = time.perf_counter() - wall
+        result = {'program': program or os.path.basename(sys.argv[0]),
+                  'argv': sys.argv[1:],
+                  'host': socket.gethostname(),
+                  'pid': os.getpid(),
+                  'start': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                         time.localtime(start)),
+                  'wall_seconds': elapsed}
+        result.update(STATS.snapshot())
+        result['rates'] = dict(('%s_per_s' % name,
+                                n/elapsed if elapsed > 0 else 0.0)
+                               for name, n in STATS.counters.items())
+        if trace_memory:
+            result['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        if report:
+            fp = open(report, 'w')
+            json.dump(result, fp, indent=1, sort_keys=True)
+            fp.write('\n')
+            fp.close()
@@ -0,0 +1,160 @@
+#! /usr/bin/env python
+"""Run the jobs of a Condor submit file on this machine.
+
+   A stand-in for condor_submit for testing the submit files written by
+   getdecks.py (mcnprun) without a pool. It understands the subset of the
+   submit language those files use: 'key = value' commands, $(macro)
+   expansion, and 'queue', 'queue N' and 'queue var[, var] from file'.
+   Like Condor, each job runs in a scratch directory holding only its
+   executable and transfer_input_files, and the files it creates are
+   copied back when it exits. --replace swaps in local programs, e.g. a
+   stand-in for the MCNP executable.
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+_RE_MACRO = re.compile(r'\$\(([A-Za-z_][A-Za-z0-9_.]*)\)')
+_RE_QUEUE = re.compile(r'^queue(?:\s+(\d+))?(?:\s+(.*?)\s+from\s+(\S+))?\s*$',
+                       re.IGNORECASE)
+
+
+def expand(value, macros):
+    "Expand $(name) macros in 'value' (case-insensitive, unknown -> '')"
+    return _RE_MACRO.sub(lambda m: macros.get(m.group(1).lower(), ''), value)
+
+
+def _split_item(line, num_vars):
+    # all but the last variable take one comma- or space-separated field,
+    # the last takes the rest of the line
+    fields = []
+    rest = line.strip()
+    for n in range(num_vars - 1):
+        parts = re.split(r'[\s,]+', rest, 1)
+        fields.append(parts[0])
+        rest = parts[1] if len(parts) > 1 else ''
+    fields.append(rest)
+    return fields
+
+
+def parse_submit(submitfile):
+    """Return a list of jobs, each a dict of lowercase command -> value
+       with every macro expanded, for the queue statements in 'submitfile'"""
+    fp = open(submitfile)
+    lines = fp.read().splitlines()
+    fp.close()
+    return parse_submit_lines(lines,
+                              os.path.dirname(os.path.abspath(submitfile)))
+
+
+def parse_submit_lines(lines, directory='.'):
+    """parse_submit for the 'lines' of a submit description, whose item
+       files are in 'directory'"""
+    commands = {}
+    jobs = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        m = _RE_QUEUE.match(line)
+        if m is None:
+            key, sep, value = line.partition('=')
+            if not sep:
+                raise ValueError("Can't parse submit line: %s" % line)
+            commands[key.strip().lower()] = value.strip()
+            continue
+        count = int(m.group(1) or 1)
+        if m.group(3):
+            names = [name.strip().lower()
+                     for name in m.group(2).split(',')]
+            fp = open(os.path.join(directory, m.group(3)))
+            items = [_split_item(item, len(names))
+                     for item in fp.read().splitlines() if item.strip()]
+            fp.close()
+        else:
+            names = []
+            items = [[]]
+        for item in items:
+            for n in range(count):
+                macros = dict(commands)
+                macros.update(zip(names, item))
+                macros['process'] = str(len(jobs))
+                jobs.append(dict((key, expand(value, macros))
+                                 for key, value in commands.items()))
+    return jobs
+
+
+def run_job(job, directory='.', replace=None, scratch_root=None):
+    """Run one job from parse_submit in a scratch directory and return its
+       exit status; 'replace' maps executable or input file names to local
+       files to use instead"""
+    replace = replace or {}
+    scratch = tempfile.mkdtemp(prefix='job', dir=scratch_root)
+    try:
+        executable = job['executable']
+        inputs = [name.strip()
+                  for name in job.get('transfer_input_files', '').split(',')
+                  if name.strip()]
+        for name in [executable] + inputs:
+            source = replace.get(name, os.path.join(directory, name))
+            shutil.copy(source, os.path.join(scratch, os.path.basename(name)))
+        transferred = set(os.listdir(scratch))
+        command = [os.path.join(scratch, os.path.basename(executable))]
+        if replace.get(executable, executable).endswith('.py'):
+            command.insert(0, sys.executable)
+        command += job.get('arguments', '').split()
+        out = open(os.path.join(directory, job.get('output', os.devnull)), 'w')
+        err = open(os.path.join(directory, job.get('error', os.devnull)), 'w')
+        try:
+            status = subprocess.call(command, cwd=scratch,
+                                     stdout=out, stderr=err)
+        finally:
+            out.close()
+            err.close()
+        for name in os.listdir(scratch):
+            if name not in transferred:
+                shutil.move(os.path.join(scratch, name),
+                            os.path.join(directory, name))
+        if 'log' in job:
+            fp = open(os.path.join(directory, job['log']), 'a')
+            fp.write("Job terminated with status %d\n" % status)
+            fp.close()
+        return status
+    finally:
+        shutil.rmtree(scratch)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Run the jobs of a Condor submit file locally")
+    parser.add_argument('submitfile', nargs='?', default='mcnprun')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="number of jobs to run at once")
+    parser.add_argument('--replace', action='append', default=[],
+                        metavar='NAME=PATH',
+                        help="use local file PATH wherever the job's "
+                             "executable or an input file is NAME")
+    parser.add_argument('--scratch', help="where to make job directories")
+    args = parser.parse_args(args)
+    replace = dict(item.split('=', 1) for item in args.replace)
+    directory = os.path.dirname(os.path.abspath(args.submitfile))
+    jobs = parse_submit(args.submitfile)
+    pool = ThreadPool(args.jobs)
+    try:
+        statuses = pool.map(lambda job: run_job(job, directory, replace,
+                                                args.scratch), jobs)
+    finally:
+        pool.close()
+        pool.join()
+    failed = sum(1 for status in statuses if status != 0)
+    sys.stdout.write("%d jobs, %d failed\n" % (len(jobs), failed))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,8 +3,9 @@ from __future__ import print_function
 from __future__ import division
 from __future__ import absolute_import
 from __future__ import unicode_literals
+import collections
+import functools
 import re
-import pandas as pd
 
 #Table of elements with mcnp libraries
 #                 Symbol Z    Mass    mcnp
@@ -63,8 +64,10 @@ _ELEMENTINFO = """H      1     1.008  1001.60c
                   U-238 92   238.029  92238.74c"""
 
 ELEMENTS = {}
+ELEMENT_ORDER = []  # fixed element registry: ELEMENTS in table order
 for line in _ELEMENTINFO.split('\n'):
     items = line.strip().split()
+    ELEMENT_ORDER.append(items[0])
     ELEMENTS[items[0]] = dict(Z=int(items[1]),
                               A=float(items[2]),
                               mcnp=items[3])
@@ -89,6 +92,66 @@ ABUNDANCES = {'B-10': 0.199,
               'U-235': 0.0072,
               'U-234': 0.00054,
              }
+# Natural elements that get split into the isotopes above, in the order
+# separate_boron and separate_uranium add them
+_NATURAL_ISOTOPES = (('B', ('B-10', 'B-11')),
+                     ('U', ('U-238', 'U-235', 'U-234')))
+
+# Array forms of the registry, indexed like ELEMENT_ORDER. The NumPy ones
+# (ATOMIC_MASSES and the isotope split) are built on first use, so that
+# importing this module and writing single cards don't need NumPy.
+ELEMENT_INDEX = dict((element, i) for i, element in enumerate(ELEMENT_ORDER))
+
+@functools.lru_cache(maxsize=None)
+def _atomic_masses():
+    import numpy as np
+    return np.array([atomic_mass(element) for element in ELEMENT_ORDER])
+
+@functools.lru_cache(maxsize=None)
+def _isotope_split():
+    # Identity, except that natural B and U are mapped onto their isotopes,
+    # so fracs.dot(_isotope_split()) does separate_boron and
+    # separate_uranium in one step.
+    import numpy as np
+    split = np.identity(len(ELEMENT_ORDER))
+    for natural, isotopes in _NATURAL_ISOTOPES:
+        i = ELEMENT_INDEX[natural]
+        split[i, i] = 0.0
+        for isotope in isotopes:
+            split[i, ELEMENT_INDEX[isotope]] = ABUNDANCES[isotope]
+    return split
+
+def __getattr__(name):
+    # ATOMIC_MASSES is still a module attribute, it is just made lazily
+    if name == 'ATOMIC_MASSES':
+        return _atomic_masses()
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(
+        __name__, name))
+
+def _zaid_order():
+    # Material cards list ZAIDs by Z and then A. The U isotopes share an A
+    # in the table; get_material_card lists tied elements in the order of
+    # the composition, and an array has no order, so here ties take the
+    # order in which separate_uranium adds the isotopes, which is the
+    # order of a composition that only had natural U.
+    tiebreak = dict((isotope, n) for natural, isotopes in _NATURAL_ISOTOPES
+                    for n, isotope in enumerate(isotopes))
+    return sorted(range(len(ELEMENT_ORDER)),
+                  key=lambda i: (atomic_number(ELEMENT_ORDER[i]),
+                                 atomic_mass(ELEMENT_ORDER[i]),
+                                 tiebreak.get(ELEMENT_ORDER[i], 0)))
+_ZAID_ORDER = _zaid_order()
+_ZAID_KEY = dict((element, (atomic_number(element), atomic_mass(element)))
+                 for element in ELEMENT_ORDER)
+# Elements that can be listed explicitly and share their (Z, A) with
+# another one, so that where they go on a card depends on the composition
+_TIED_ELEMENTS = frozenset(
+    element for element in ELEMENT_ORDER
+    if list(_ZAID_KEY.values()).count(_ZAID_KEY[element]) > 1) - frozenset(
+        natural for natural, isotopes in _NATURAL_ISOTOPES)
+# One material-card entry per element, waiting for its fraction
+_ZAID_FIELDS = ["{0:>10} %.7e ".format(mcnp_library(element))
+                for element in ELEMENT_ORDER]
 
 # Regex to match an element (with an optional isotope tag)
 # followed by an optional float
@@ -99,6 +162,63 @@ _RE_ELEMENTS = re.compile(r"""
     """, re.VERBOSE)
 
 
+class LRUCache(object):
+    """A cache of at most 'maxsize' entries that evicts the least recently
+       used one when full, and counts its hits, misses and evictions.
+       A 'maxsize' of 0 turns the cache off.
+
+       >>> cache = LRUCache(2)
+       >>> cache.put('a', 1); cache.put('b', 2)
+       >>> cache.get('a')
+       1
+       >>> cache.put('c', 3)
+       >>> print(cache.get('b'))
+       None
+       >>> sorted(cache.stats().items())
+       [('evictions', 1), ('hits', 1), ('maxsize', 2), ('misses', 1), ('size', 2)]
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+    def __len__(self):
+        return len(self._entries)
+    def get(self, key, default=None):
+        "Return the entry for 'key' (and mark it used), or 'default'"
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._evict()
+    def resize(self, maxsize):
+        "Change the size limit, evicting entries if there are too many"
+        self.maxsize = maxsize
+        self._evict()
+    def clear(self):
+        "Drop every entry and reset the counts"
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._entries),
+                'maxsize': self.maxsize}
+
+# Parsed formula strings: formula -> ((element, weight), ...) in formula
+# order, so each distinct formula goes through _RE_ELEMENTS once
+FORMULA_CACHE = LRUCache(1024)
+
+
 class ElementalComposition(dict):
     """Class for elemental compositions.
 
@@ -127,7 +247,7 @@ class ElementalComposition(dict):
         not_a_dict = not_a_string = False
         try:
             elements = list(input.keys())
-            for key in keys:
+            for key in elements:
                 self[key] = input[key]
         except AttributeError:
             not_a_dict = True
@@ -148,13 +268,12 @@ class ElementalComposition(dict):
         for element in self:
             self[element] /= fracsum
     def _parse_formula(self, formula):
-        for m in _RE_ELEMENTS.finditer(formula):
-            element = m.group(1)
-            wt = m.group(2)
-            if wt:
-                wt = float(wt)
-            else:
-                wt = 1
+        parsed = FORMULA_CACHE.get(formula)
+        if parsed is None:
+            parsed = tuple((m.group(1), float(m.group(2)) if m.group(2) else 1)
+                           for m in _RE_ELEMENTS.finditer(formula))
+            FORMULA_CACHE.put(formula, parsed)
+        for element, wt in parsed:
             try:
                 self[element] += wt
             except KeyError:
@@ -183,6 +302,96 @@ class ElementalComposition(dict):
             del self[isotope]
 
 
+class CompactComposition(object):
+    """Array-backed elemental composition.
+
+       Holds the mole fractions as a float64 vector indexed by
+       ELEMENT_ORDER, so arithmetic is done with vector operations and
+       a composition costs 8 bytes per registry element. It can be
+       initialized like an ElementalComposition (formula string, dict,
+       or nothing), from another CompactComposition (which makes a copy),
+       or from a vector, which is used without copying so that rows of
+       a large array returned by compositions_to_array can be wrapped.
+
+       >>> comp = CompactComposition('CaCO3MgCO3')
+       >>> comp.norm_fracs_to_one()
+       >>> print(sorted(comp.to_dict().items()))
+       [('C', 0.2), ('Ca', 0.1), ('Mg', 0.1), ('O', 0.6)]
+       >>> comp = CompactComposition('B 2 U 1')
+       >>> comp.separate_isotopes()
+       >>> print(sorted(comp.to_dict().items()))
+       [('B-10', 0.398), ('B-11', 1.602), ('U-234', 0.00054), ('U-235', 0.0072), ('U-238', 0.99275)]
+    """
+    __slots__ = ('fracs',)
+
+    def __init__(self, input=None):
+        import numpy as np
+        if isinstance(input, CompactComposition):
+            self.fracs = input.fracs.copy()
+        elif isinstance(input, np.ndarray):
+            if input.shape != (len(ELEMENT_ORDER),):
+                raise ValueError(
+                    "Invalid input to CompactComposition: "
+                    "expected a vector of length {0}".format(len(ELEMENT_ORDER)))
+            self.fracs = input
+        else:
+            self.fracs = np.zeros(len(ELEMENT_ORDER))
+            if input:
+                if not isinstance(input, ElementalComposition):
+                    input = ElementalComposition(input)
+                for element in input:
+                    self.fracs[ELEMENT_INDEX[element]] += input[element]
+    def __repr__(self):
+        return "CompactComposition({0!r})".format(dict(self.to_dict()))
+    def __add__(self, other):
+        return CompactComposition(self.fracs + other.fracs)
+    def __iadd__(self, other):
+        self.fracs += other.fracs
+        return self
+    def __mul__(self, scale):
+        return CompactComposition(self.fracs*scale)
+    __rmul__ = __mul__
+    def __imul__(self, scale):
+        self.fracs *= scale
+        return self
+    @property
+    def molar_mass(self):
+        return float(self.fracs.dot(_atomic_masses()))
+    def norm_fracs_to_one(self):
+        self.fracs /= self.fracs.sum()
+    def separate_isotopes(self):
+        "Replace natural B and U by their isotopes (see ABUNDANCES)"
+        self.fracs = self.fracs.dot(_isotope_split())
+    def to_dict(self):
+        "Return an ElementalComposition holding the nonzero fractions"
+        import numpy as np
+        return ElementalComposition(
+            dict((ELEMENT_ORDER[i], float(self.fracs[i]))
+                 for i in np.flatnonzero(self.fracs)))
+
+
+def compositions_to_array(comps):
+    """Stack compositions into an (n, len(ELEMENT_ORDER)) float64 array.
+
+       'comps' may hold ElementalComposition or CompactComposition objects
+       (or anything CompactComposition accepts). Rows can be wrapped again
+       with CompactComposition(array[i]), and separated into isotopes all
+       at once with separate_isotopes(array).
+    """
+    import numpy as np
+    comps = list(comps)
+    fracs = np.zeros((len(comps), len(ELEMENT_ORDER)))
+    for i, comp in enumerate(comps):
+        if not isinstance(comp, CompactComposition):
+            comp = CompactComposition(comp)
+        fracs[i] = comp.fracs
+    return fracs
+
+
+def separate_isotopes(fracs):
+    "Return a copy of an array of ELEMENT_ORDER fractions with B and U split"
+    import numpy as np
+    return np.asarray(fracs, dtype=float).dot(_isotope_split())
 
 
 def add_compositions_by_mole_fracs(comps, mole_fracs, norm=True):
@@ -256,35 +465,91 @@ def get_material_card(name, density, composition, material_number=1):
        c
           m1  6000.60c 0.199982  12000.60c 0.099991   5010.60c 0.000092
              20000.60c 0.099991   8016.60c 0.599945
+
+       Elements with the same Z and A (the U isotopes) are listed in the
+       order of the composition:
+       >>> comp = ElementalComposition({'U-235': 0.9, 'U-238': 0.1})
+       >>> print(get_material_card('fuel', 19.0, comp).splitlines()[-1])
+          m1 92235.74c 9.0000000e-01  92238.74c 1.0000000e-01
     """
     header = _CARD_HEADER.format(material_number, name, density)
-    lines = header.split('\n')
-    m = "m{0:d}".format(material_number)
-    leader = "{0:>5}".format(m)
-    line = [leader]
     composition.separate_boron() # no 5000 library in MCNP5 or MCNP6
     composition.separate_uranium() # no 92000 library in MCNP5 or MCNP6
     composition.remove_zero_fracs() # no need to list isotopes that aren't there
-    elements = list(composition.keys())
-    tmpdf = pd.DataFrame({'Z':[atomic_number(element) for element in elements],
-                          'A':[atomic_mass(element) for element in elements]})
-    tmpdf.index = elements
-    sortdf = tmpdf.sort_values(['Z', 'A'])
-    sorted_elements = sortdf.index
-    #for n,element in enumerate(composition):
-    for n,element in enumerate(sorted_elements):
-        line.append("{0:>10} {1:.7e} ".format(
-            mcnp_library(element),
-            composition[element]))
-        if (n+1)%3 == 0:
-            lines.append("".join(line))
-            line = ["     "]
-    remainder = "".join(line).rstrip()
+    sorted_elements = sorted(composition, key=_ZAID_KEY.__getitem__)
+    entries = [_ZAID_FIELDS[ELEMENT_INDEX[element]] % composition[element]
+               for element in sorted_elements]
+    return _format_card(header, material_number, entries)
+
+
+def get_material_cards(names, densities, compositions, material_numbers=1):
+    """Return a list of mcnp material cards, one per composition.
+
+       Batch form of get_material_card, producing identical cards.
+       'compositions' is either an (n, len(ELEMENT_ORDER)) array of mole
+       fractions, such as the output of a vectorized mixer, or a sequence
+       of compositions, which is stacked with compositions_to_array.
+       'material_numbers' is a single number or one per card. The
+       compositions are not modified. Compositions that list U isotopes
+       themselves are formatted by get_material_card, which lists them in
+       the composition's order; rows of an array have no order, so tied
+       isotopes come as separate_uranium adds them.
+       >>> comps = [ElementalComposition('CaCO3MgCO3'), ElementalComposition('B')]
+       >>> cards = get_material_cards(['dolomite', 'boron'], [2.851, 2.34], comps)
+       >>> print(cards[1])
+       c
+       c    ===================================================================
+       c    ==== Material #    1
+       c    ===================================================================
+       c    Name    = boron
+       c    Density =    2.3400 g/cc
+       c
+          m1  5010.74c 1.9900000e-01   5011.74c 8.0100000e-01
+    """
+    import numpy as np
+    explicit = {}
+    if not isinstance(compositions, np.ndarray):
+        compositions = list(compositions)
+        for n, comp in enumerate(compositions):
+            if isinstance(comp, dict) and _TIED_ELEMENTS.intersection(comp):
+                explicit[n] = comp
+        compositions = compositions_to_array(compositions)
+    ordered = separate_isotopes(compositions)[:, _ZAID_ORDER]
+    if isinstance(material_numbers, int):
+        material_numbers = [material_numbers]*len(ordered)
+    fields = [_ZAID_FIELDS[i] for i in _ZAID_ORDER]
+    cards = []
+    for n, (name, density, number, fracs) in enumerate(
+            zip(names, densities, material_numbers, ordered)):
+        if n in explicit:
+            cards.append(get_material_card(
+                name, density, ElementalComposition(explicit[n]), number))
+            continue
+        header = _CARD_HEADER.format(number, name, density)
+        nonzero = np.flatnonzero(fracs)
+        entries = [fields[i] % frac
+                   for i, frac in zip(nonzero.tolist(), fracs[nonzero].tolist())]
+        cards.append(_format_card(header, number, entries))
+    return cards
+
+
+def _format_card(header, material_number, entries):
+    # Three entries per line after the "mN" leader; full lines keep their
+    # trailing space, the last partial line doesn't.
+    lines = [header]
+    line = "{0:>5}".format("m{0:d}".format(material_number))
+    for start in range(0, len(entries), 3):
+        chunk = "".join(entries[start:start + 3])
+        if start + 3 <= len(entries):
+            lines.append(line + chunk)
+            line = "     "
+        else:
+            line += chunk
+    remainder = line.rstrip()
     if remainder:
         lines.append(remainder)
     return "\n".join(lines)
 
-
 if __name__ == "__main__":
     import pprint
     pprint.pprint(ELEMENTS)
@@ -0,0 +1,172 @@
+"""Read MCNP's mctal tally files into NumPy arrays.
+
+   A mctal file (written when the PRDMP card's third entry is 1) holds
+   every tally's bins, values, relative errors and tally fluctuation
+   chart (TFC) in a compact, fixed layout, so reading it is much cheaper
+   than scraping the printed output. read_mctal returns the tallies;
+   examine_mctal returns the same data as ouextract.examine_ou.
+"""
+
+# the dimensions of a tally, slowest varying first, as the vals list
+# runs through them; 'u', 's', 'm', 'c', 'e' and 't' may also carry a
+# 't' (total) or 'c' (cumulative) suffix in the file
+BIN_NAMES = ('f', 'd', 'u', 's', 'm', 'c', 'e', 't')
+_KEYWORDS = set(BIN_NAMES + ('tally', 'vals', 'tfc', 'kcode')) | set(
+    name + suffix for name in BIN_NAMES[2:] for suffix in 'tc')
+
+# the TFC columns
+TFC_COLUMNS = ('nps', 'mean', 'error', 'fom')
+
+
+class Tally(object):
+    """One tally of a mctal file.
+
+       'bins' maps each of BIN_NAMES to its number of bins, 'boundaries'
+       holds the bin boundaries of the 'c', 'e' and 't' bins (if any),
+       'cells' the cell or surface numbers of the 'f' bins, and 'values'
+       and 'errors' are arrays with an axis per bin name. 'tfc' is the
+       fluctuation chart, one row of TFC_COLUMNS per entry, for the bin
+       whose (1-based) bin numbers are 'tfc_bins'.
+    """
+    def __init__(self, number, particle=0, kind=0):
+        import numpy as np
+        self.number = number
+        self.particle = particle
+        self.kind = kind
+        self.comments = []
+        self.bins = dict((name, 1) for name in BIN_NAMES)
+        self.boundaries = {}
+        self.cells = np.zeros(0)
+        self.values = self.errors = None
+        self.tfc = np.zeros((0, len(TFC_COLUMNS)))
+        self.tfc_bins = ()
+
+    @property
+    def shape(self):
+        return tuple(self.bins[name] for name in BIN_NAMES)
+
+    def tfc_value(self):
+        "Return the value and relative error of the TFC bin"
+        index = tuple(max(n, 1) - 1 for n in self.tfc_bins)
+        return self.values[index], self.errors[index]
+
+
+def _sections(lines):
+    # yield (keyword, the rest of its line's words, the numeric words of
+    # the lines after it, and any other lines after it, e.g. comments)
+    keyword = None
+    words, numbers, text = [], [], []
+    for line in lines:
+        if not line.strip():
+            continue
+        first = line.split(None, 1)[0].lower()
+        if not line[0].isspace() and first in _KEYWORDS:
+            if keyword is not None:
+                yield keyword, words, numbers, text
+            keyword, words, numbers, text = first, line.split()[1:], [], []
+        elif keyword is not None:
+            try:
+                float(first)
+            except ValueError:
+                text.append(line.strip())
+            else:
+                numbers.extend(line.split())
+    if keyword is not None:
+        yield keyword, words, numbers, text
+
+
+def parse_mctal(text):
+    """Return the header of mctal 'text' (a dict with 'code', 'nps' and
+       'title') and a dict of tally number -> Tally"""
+    import numpy as np
+    lines = text.splitlines()
+    first = lines[0].split()
+    header = {'code': first[0], 'title': lines[1].strip()}
+    try:
+        header['nps'] = int(first[-2])
+    except (IndexError, ValueError):
+        header['nps'] = None
+    tallies = {}
+    tally = None
+    for keyword, words, numbers, text in _sections(lines[2:]):
+        if keyword == 'tally':
+            tally = Tally(*[int(word) for word in words[:3]])
+            tally.comments = text
+            tallies[tally.number] = tally
+            continue
+        if tally is None:
+            continue
+        if keyword == 'vals':
+            data = np.array(numbers, dtype=float).reshape(tally.shape + (2,))
+            tally.values = data[..., 0]
+            tally.errors = data[..., 1]
+        elif keyword == 'tfc':
+            tally.tfc_bins = tuple(int(word) for word in words[1:9])
+            tally.tfc = np.array(numbers, dtype=float).reshape(
+                -1, len(TFC_COLUMNS))
+        elif keyword == 'kcode':
+            tally = None
+        else:
+            name = keyword[0]
+            tally.bins[name] = max(int(words[0]), 1)
+            if name == 'f':
+                tally.cells = np.array(numbers, dtype=float)
+            elif numbers:
+                tally.boundaries[name] = np.array(numbers, dtype=float)
+    return header, tallies
+
+
+def read_mctal(mctalfile):
+    "parse_mctal for file 'mctalfile'"
+    fp = open(mctalfile)
+    text = fp.read()
+    fp.close()
+    return parse_mctal(text)
+
+
+def tfc_failures(tfc):
+    """Return how many of the checks on the relative error that MCNP makes
+       can be made from a TFC, and fail: the last error must be below
+       0.1, and over the second half of the chart it must never increase
+       and must fall as 1/sqrt(nps), to within 10%. (MCNP's checks of the
+       mean, VOV, slope and FOM need data a mctal file doesn't have, so
+       this is no stand-in for MCNP's count, and examine_mctal does not
+       report it as stats_failed.)
+
+       >>> import numpy as np
+       >>> tfc_failures(np.array([[1e6, 1., 0.08, 1.], [2e6, 1., 0.0566, 1.]]))
+       0
+    """
+    import numpy as np
+    nps, error = tfc[:, 0], tfc[:, 2]
+    half = error[len(error)//2:]
+    scaled = half*np.sqrt(nps[len(error)//2:])
+    failed = 0
+    if not error[-1] < 0.1:
+        failed += 1
+    if np.any(np.diff(half) > 0):
+        failed += 1
+    if scaled.max() > 1.1*scaled.min():
+        failed += 1
+    return failed
+
+
+def examine_mctal(mctalfile, title='quick room shielding test'):
+    """Return ouextract.examine_ou's data for the run that wrote mctal
+       file 'mctalfile', from its first tally: the mean and error of the
+       TFC bin. The 'filename' comes from the problem title if it contains
+       'title'; material and thickness, which are only in the printed
+       input, are missing, and so is stats_failed, since MCNP's
+       statistical checks are only in the printed output."""
+    header, tallies = read_mctal(mctalfile)
+    if not tallies:
+        return None
+    tally = tallies[min(tallies)]
+    data = {}
+    if title in header['title'].lower():
+        data['filename'] = header['title'].split()[0]
+    if len(tally.tfc):
+        data['dose'], data['relerr'] = tally.tfc[-1, 1:3].tolist()
+    else:
+        data['dose'], data['relerr'] = map(float, tally.tfc_value())
+    return data
@@ -1,4 +1,29 @@
 #! /bin/env python
+"""Harvest tally results from MCNP output ('ou') files into data.csv.
+
+   examine_file parses the lines of an output file. examine_ou gets the
+   same data straight from the file: it memory-maps it and looks for the
+   tally fluctuation charts and the statistical checks at byte level,
+   starting from the end of the file, so only a few lines of a large
+   output are ever decoded. harvest runs examine_ou over many files in a
+   process pool and appends the results to data.csv. It keeps an index of
+   each output's mtime and size, so unchanged files are skipped the next
+   time it runs. Where a run also wrote a mctal file ('<deck>mc', see
+   getdecks.py --mctal), its results are read from that instead (see
+   mctal.examine_mctal), with the output file as the fallback. With
+   --store, the new results also go into a results.ResultsStore, under
+   the formation keys of the decks in getdecks.py's manifest.
+"""
+import argparse
+import csv
+import mmap
+import multiprocessing
+import os
+
+import instrument
+import mctal
+import results
+from glob import glob
 
 
 def examine_file(lines):
@@ -10,7 +35,7 @@ def examine_file(lines):
             data['material'] = line.split(':')[1].strip()
         elif "Shield thickness" in line:
             data['thickness'] = float(line.split(':')[1].split()[0])
-        elif 'passed the 10 statistical checks' in line: 
+        elif 'passed the 10 statistical checks' in line:
             data['stats_failed'] = 0
         elif 'of 10 tfc bin checks' in line:
             data['stats_failed'] = int(line.split()[0].strip())
@@ -25,18 +50,250 @@ def examine_file(lines):
             break
     return data
 
-from glob import glob
-oufiles = glob('*ou')
-dataset = []
-for oufile in sorted(oufiles):
-    lines = open(oufile).readlines()
-    dataset.append(examine_file(lines))
 
-import csv
-with open('data.csv', 'w') as f:
-    cols = dataset[0].keys()
-    writer = csv.DictWriter(f, cols)
-    writer.writeheader()
-    for row in dataset:
-        writer.writerow(row)
+_TALLY_CHARTS = b'1tally fluctuation charts'
+_PASSED = b'passed the 10 statistical checks'
+_FAILED = b'of 10 tfc bin checks'
+_TITLE = b'quick room shielding test'  # matched in any case
+_HEAD = 1 << 20  # the input echo is near the start of the file
+
+
+def _line_at(buf, pos):
+    "Return the decoded line of 'buf' containing offset 'pos'"
+    start = buf.rfind(b'\n', 0, pos) + 1
+    end = buf.find(b'\n', pos)
+    if end < 0:
+        end = len(buf)
+    return buf[start:end].decode('latin-1')
+
+
+def examine_buffer(buf):
+    """examine_file for the bytes (or mmap) of a whole output file.
+
+       Uses the last tally fluctuation charts in the file and the last
+       statistical check lines before them. The input-echo lines are
+       looked for only in the first _HEAD bytes. Returns None if the file
+       has no tally fluctuation charts (yet).
+    """
+    tally_pos = buf.rfind(_TALLY_CHARTS)
+    if tally_pos < 0:
+        return None
+    tally_pos = buf.rfind(b'\n', 0, tally_pos) + 1
+    data = {}
+    head = min(_HEAD, tally_pos)
+    pos = buf[:head].lower().find(_TITLE)
+    if pos >= 0:
+        data['filename'] = _line_at(buf, pos).split()[0]
+    pos = buf.find(b'Shield material', 0, head)
+    if pos >= 0:
+        data['material'] = _line_at(buf, pos).split(':')[1].strip()
+    pos = buf.find(b'Shield thickness', 0, head)
+    if pos >= 0:
+        data['thickness'] = float(_line_at(buf, pos).split(':')[1].split()[0])
+    passed = buf.rfind(_PASSED, 0, tally_pos)
+    failed = buf.rfind(_FAILED, 0, tally_pos)
+    if passed >= 0 and passed > failed:
+        data['stats_failed'] = 0
+    elif failed >= 0:
+        data['stats_failed'] = int(_line_at(buf, failed).split()[0].strip())
+    # the values are on the last line before the first blank line that
+    # follows the chart's three heading lines
+    start = tally_pos
+    for n in range(4):
+        start = buf.find(b'\n', start) + 1
+        if start == 0:
+            return data
+    prev = _line_at(buf, start - 1)
+    while start < len(buf):
+        end = buf.find(b'\n', start)
+        if end < 0:
+            end = len(buf)
+        line = buf[start:end]
+        if line.strip() == b'':
+            vals = prev.split()
+            data['dose'], data['relerr'] = float(vals[1]), float(vals[2])
+            break
+        prev = line.decode('latin-1')
+        start = end + 1
+    return data
+
+
+def examine_ou(oufile):
+    "Return examine_buffer's data for output file 'oufile'"
+    with open(oufile, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return examine_buffer(buf)
+
+
+DATA_COLUMNS = ('oufile', 'filename', 'material', 'thickness',
+                'stats_failed', 'dose', 'relerr')
+INDEX_COLUMNS = ('oufile', 'mtime_ns', 'size')
+
+
+def get_index_filename(datafile):
+    return datafile + '.index'
+
+
+def read_index(indexfile):
+    """Return a dict of output file -> (mtime_ns, size) when last harvested.
+       The index is append-only, so later lines win."""
+    index = {}
+    if not os.path.exists(indexfile):
+        return index
+    with open(indexfile, newline='') as fp:
+        for record in csv.reader(fp):
+            if record and record[0] != INDEX_COLUMNS[0]:
+                index[record[0]] = (int(record[1]), int(record[2]))
+    return index
+
+
+def _stamp(oufile):
+    st = os.stat(oufile)
+    return st.st_mtime_ns, st.st_size
+
+
+def get_mctal_filename(oufile):
+    "Return the name of the mctal file of the run that wrote 'oufile'"
+    return (oufile[:-2] if oufile.endswith('ou') else oufile) + 'mc'
+
+
+def examine_run(oufile):
+    """Return the data of the run that wrote 'oufile', from its mctal file
+       if there is a readable one, and otherwise from 'oufile' itself"""
+    mctalfile = get_mctal_filename(oufile)
+    if os.path.exists(mctalfile):
+        try:
+            data = mctal.examine_mctal(mctalfile)
+        except (ValueError, IndexError, KeyError):
+            data = None
+        if data is not None:
+            instrument.count('mctal_parsed')
+            instrument.count('bytes_parsed', os.path.getsize(mctalfile))
+            return data
+    instrument.count('bytes_parsed', os.path.getsize(oufile))
+    return examine_ou(oufile)
+
+
+def _examine(oufile):
+    # stat before reading, so a file that changes while it is read is
+    # looked at again next time
+    with instrument.collect() as stats:
+        stamp = _stamp(oufile)
+        with instrument.stage('examine'):
+            data = examine_run(oufile)
+        instrument.count('files_parsed')
+    return oufile, stamp, data, stats.snapshot()
+
+
+def harvest(oufiles, datafile='data.csv', workers=1, rebuild=False):
+    """Append the results of every new or changed output file to 'datafile'.
+
+       Files whose mtime and size match the index next to 'datafile' are
+       skipped, as are files without tally fluctuation charts (they are
+       looked at again next time). A rerun output gets a new row, so the
+       last row for an 'oufile' is the current one. With 'rebuild',
+       'datafile' and its index are started afresh. Returns the new rows.
+    """
+    indexfile = get_index_filename(datafile)
+    if rebuild:
+        for filename in (datafile, indexfile):
+            if os.path.exists(filename):
+                os.remove(filename)
+    if os.path.exists(datafile):
+        with open(datafile, newline='') as fp:
+            header = next(csv.reader(fp), None)
+        if header is not None and tuple(header) != DATA_COLUMNS:
+            raise ValueError("{0} has columns {1}, not {2}; rebuild it"
+                             .format(datafile, header, list(DATA_COLUMNS)))
+    with instrument.stage('index'):
+        index = read_index(indexfile)
+        oufiles = sorted(oufiles)
+        todo = [oufile for oufile in oufiles
+                if index.get(oufile) != _stamp(oufile)]
+    instrument.count('files_skipped', len(oufiles) - len(todo))
+    new_data = not os.path.exists(datafile) or os.path.getsize(datafile) == 0
+    new_index = not os.path.exists(indexfile) or os.path.getsize(indexfile) == 0
+    rows = []
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        if pool is not None:
+            examined = pool.imap(_examine, todo, chunksize=8)
+        else:
+            examined = map(_examine, todo)
+        with open(datafile, 'a', newline='') as datafp, \
+                open(indexfile, 'a', newline='') as indexfp:
+            writer = csv.DictWriter(datafp, DATA_COLUMNS)
+            index_writer = csv.writer(indexfp)
+            if new_data:
+                writer.writeheader()
+            if new_index:
+                index_writer.writerow(INDEX_COLUMNS)
+            for oufile, stamp, data, stats in examined:
+                instrument.merge(stats)
+                if data is None:
+                    instrument.count('files_unfinished')
+                    continue
+                data['oufile'] = oufile
+                with instrument.stage('write'):
+                    writer.writerow(data)
+                    index_writer.writerow((oufile,) + stamp)
+                instrument.count('rows_written')
+                rows.append(data)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return rows
+
+
+def store_results(rows, storefile, manifestfile='manifest.csv'):
+    """Record harvested 'rows' in the results store 'storefile', using the
+       deck records of getdecks.py manifest 'manifestfile'"""
+    with instrument.stage('store'):
+        runs = results.get_runs(rows,
+                                results.read_manifest_records(manifestfile))
+        store = results.ResultsStore(storefile)
+        try:
+            store.add_runs(runs)
+        finally:
+            store.close()
+    instrument.count('runs_stored', len(runs))
+    return runs
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Collect MCNP tally results from *ou files into a csv")
+    parser.add_argument('oufiles', nargs='*',
+                        help="output files (default: *ou)")
+    parser.add_argument('-o', '--output', default='data.csv',
+                        help="csv file to append results to")
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help="number of processes reading output files")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="re-read every output file and rewrite the csv")
+    parser.add_argument('--store',
+                        help="also record the new results in this results "
+                             "store (SQLite), by formation")
+    parser.add_argument('--manifest', default='manifest.csv',
+                        help="getdecks.py manifest of the decks, for --store")
+    parser.add_argument('--report', default='ouextract-report.json',
+                        help="JSON file for the run's stage timings and "
+                             "counters ('' for none)")
+    parser.add_argument('--profile',
+                        help="write cProfile stats of the main process here")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="report the peak memory traced by tracemalloc")
+    args = parser.parse_args(args)
+    with instrument.session(args.report, args.profile, args.trace_memory,
+                            'ouextract'):
+        oufiles = args.oufiles or glob('*ou')
+        rows = harvest(oufiles, args.output, args.workers, args.rebuild)
+        if args.store:
+            store_results(rows, args.store, args.manifest)
+
 
+if __name__ == "__main__":
+    main()
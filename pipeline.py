@@ -0,0 +1,345 @@
+#! /usr/bin/env python
+"""Generate, run and harvest decks as one streaming pipeline.
+
+   Instead of writing every deck (getdecks.py), submitting them all and
+   harvesting once they have all finished (ouextract.py), the three
+   stages run at once under asyncio: decks are written a row of the XRD
+   table at a time, handed to a runner through a bounded queue, and each
+   run's results are read and appended to data.csv as soon as it ends.
+   The queue bounds how many decks are waiting on disk, so generation
+   only keeps ahead of the runs, and the first results come in after the
+   first runs. Runners are LocalRunner (jobs run like localrun.py does,
+   e.g. with fakemcnp.py standing in for MCNP) and CondorRunner (one
+   condor_submit per deck, watching its log for the end of the job).
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import os
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import getdecks
+import instrument
+import localrun
+import ouextract
+import results
+
+
+def get_job_lines(deck, mctal=False):
+    "Return the lines of a submit file that runs 'deck' alone"
+    return (getdecks.submit_header + '\n'
+            + getdecks.get_submit_entry(deck, mctal)).splitlines()
+
+
+class LocalRunner(object):
+    """Runs decks on this machine, 'jobs' at a time, each in a scratch
+       directory as localrun.py does; 'replace' is as for localrun.run_job"""
+    def __init__(self, jobs=1, replace=None, mctal=False, scratch=None,
+                 directory='.'):
+        self.jobs = jobs
+        self.replace = replace or {}
+        self.mctal = mctal
+        self.scratch = scratch
+        self.directory = directory
+        self.executor = ThreadPoolExecutor(jobs)
+
+    async def run(self, deck):
+        "Run 'deck' and return its exit status"
+        job = localrun.parse_submit_lines(get_job_lines(deck, self.mctal),
+                                          self.directory)[0]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, localrun.run_job,
+                                          job, self.directory, self.replace,
+                                          self.scratch)
+
+    def close(self):
+        self.executor.shutdown()
+
+
+_RE_TERMINATED = re.compile(r'^005 .*?\n\s*\((\d)\) (?:Normal termination '
+                            r'\(return value (\d+)\))?', re.MULTILINE)
+_RE_ABORTED = re.compile(r'^009 ', re.MULTILINE)
+
+
+def get_exit_status(logfile):
+    """Return the exit status of the job of Condor user log 'logfile', -1
+       if it was aborted or killed, or None while it hasn't finished"""
+    if not os.path.exists(logfile):
+        return None
+    fp = open(logfile)
+    log = fp.read()
+    fp.close()
+    m = _RE_TERMINATED.search(log)
+    if m is not None:
+        return int(m.group(2)) if m.group(1) == '1' else -1
+    if _RE_ABORTED.search(log):
+        return -1
+    return None
+
+
+class CondorRunner(object):
+    """Submits each deck as its own Condor job, with at most 'jobs' in the
+       queue, and polls the job's log every 'poll' seconds until it ends"""
+    def __init__(self, jobs=100, mctal=False, poll=30.0,
+                 submit='condor_submit'):
+        self.jobs = jobs
+        self.mctal = mctal
+        self.poll = poll
+        self.submit = submit
+
+    async def run(self, deck):
+        "Run 'deck' and return its exit status"
+        submitfile = '%s.sub' % deck
+        fp = open(submitfile, 'w')
+        fp.write('\n'.join(get_job_lines(deck, self.mctal)) + '\n')
+        fp.close()
+        process = await asyncio.create_subprocess_exec(
+            self.submit, submitfile, stdout=asyncio.subprocess.DEVNULL)
+        if await process.wait() != 0:
+            return -1
+        while True:
+            status = get_exit_status('%s.log' % deck)
+            if status is not None:
+                return status
+            await asyncio.sleep(self.poll)
+
+    def close(self):
+        pass
+
+
+def write_rows(deck_template, chunks, sweep, num_repeats, num_rows,
+               study_seed=0, store=None, target_relerr=None, first_deck=1):
+    """Write the decks of the XRD table a row at a time, yielding each
+       row's manifest records (see getdecks.write_decks). The decks are
+       numbered from 'first_deck' and seeded as by getdecks.generate with
+       'study_seed'."""
+    decks_per_row = len(sweep)*num_repeats
+    filename_format = getdecks.get_filename_format(first_deck,
+                                                   num_rows*decks_per_row)
+    date = str(datetime.date.today())
+    filenum = first_deck
+    for chunk in chunks:
+        for start in range(len(chunk)):
+            seeds = [getdecks.get_deck_seed(n, study_seed)
+                     for n in range(filenum, filenum + decks_per_row)]
+            entries, records = getdecks.write_decks(
+                deck_template, chunk.iloc[start:start + 1], sweep,
+                num_repeats, seeds, filenum, date, filename_format,
+                store=store, target_relerr=target_relerr)
+            filenum += decks_per_row
+            yield records
+
+
+async def generate(rows, decks, manifestfp):
+    "Put the records of the decks 'rows' writes on the 'decks' queue"
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(1)
+    writer = csv.writer(manifestfp)
+    writer.writerow(getdecks.MANIFEST_COLUMNS)
+    try:
+        while True:
+            with instrument.stage('generate'):
+                records = await loop.run_in_executor(executor, next, rows,
+                                                     None)
+            if records is None:
+                break
+            writer.writerows(records)
+            manifestfp.flush()
+            for record in records:
+                await decks.put(dict(zip(getdecks.MANIFEST_COLUMNS, record)))
+    finally:
+        executor.shutdown()
+
+
+async def run(runner, decks, finished):
+    """Run the decks from the 'decks' queue until a None, for 'finished'.
+       A run that fails, even by raising, counts as failed and its record
+       still goes on, so the other stages never wait for it.
+
+       >>> class Broken(object):
+       ...     async def run(self, deck):
+       ...         raise OSError("no mcnp611.sh")
+       >>> async def run_one():
+       ...     decks, finished = asyncio.Queue(), asyncio.Queue()
+       ...     for record in ({'filename': 's00001'}, None):
+       ...         decks.put_nowait(record)
+       ...     await run(Broken(), decks, finished)
+       ...     return finished.get_nowait()
+       >>> asyncio.run(run_one())
+       {'filename': 's00001'}
+    """
+    while True:
+        record = await decks.get()
+        if record is None:
+            break
+        try:
+            status = await runner.run(record['filename'])
+        except Exception as e:
+            sys.stderr.write("%s: could not be run: %s\n"
+                             % (record['filename'], e))
+            status = -1
+        else:
+            if status != 0:
+                sys.stderr.write("%s: exited with status %d\n"
+                                 % (record['filename'], status))
+        instrument.count('runs')
+        if status != 0:
+            instrument.count('runs_failed')
+        await finished.put(record)
+
+
+async def harvest(finished, datafile, store=None, cleanup=False):
+    """Append the results of each run from the 'finished' queue to
+       'datafile' (and its ouextract.py index), and to results store
+       'store', until a None"""
+    loop = asyncio.get_running_loop()
+    indexfile = ouextract.get_index_filename(datafile)
+    new_data = not os.path.exists(datafile) or os.path.getsize(datafile) == 0
+    new_index = not os.path.exists(indexfile) or os.path.getsize(indexfile) == 0
+    store = results.ResultsStore(store) if store else None
+    with open(datafile, 'a', newline='') as datafp, \
+            open(indexfile, 'a', newline='') as indexfp:
+        writer = csv.DictWriter(datafp, ouextract.DATA_COLUMNS)
+        index_writer = csv.writer(indexfp)
+        if new_data:
+            writer.writeheader()
+        if new_index:
+            index_writer.writerow(ouextract.INDEX_COLUMNS)
+        while True:
+            record = await finished.get()
+            if record is None:
+                break
+            deck = record['filename']
+            oufile = '%sou' % deck
+            if not os.path.exists(oufile):
+                continue
+            stamp = ouextract._stamp(oufile)
+            with instrument.stage('harvest'):
+                data = await loop.run_in_executor(None, ouextract.examine_run,
+                                                  oufile)
+            if data is None:
+                instrument.count('files_unfinished')
+                continue
+            data['oufile'] = oufile
+            writer.writerow(data)
+            index_writer.writerow((oufile,) + stamp)
+            datafp.flush()
+            indexfp.flush()
+            instrument.count('rows_written')
+            if store is not None:
+                store.add_runs(results.get_runs([data], {deck: record}))
+            if cleanup:
+                for filename in ('%sin' % deck, '%sta' % deck):
+                    if os.path.exists(filename):
+                        os.remove(filename)
+    if store is not None:
+        store.close()
+
+
+async def pipeline(rows, runner, manifestfp, datafile='data.csv',
+                   store=None, max_pending=None, cleanup=False):
+    """Run 'rows' (see write_rows) through 'runner' and harvest the
+       results, with at most 'max_pending' decks (by default twice the
+       runner's jobs) written but not yet started"""
+    if max_pending is None:
+        max_pending = 2*runner.jobs
+    decks = asyncio.Queue(max_pending)
+    finished = asyncio.Queue(max_pending)
+    harvester = asyncio.ensure_future(harvest(finished, datafile, store,
+                                              cleanup))
+    runners = [asyncio.ensure_future(run(runner, decks, finished))
+               for n in range(runner.jobs)]
+    await generate(rows, decks, manifestfp)
+    for task in runners:
+        await decks.put(None)
+    await asyncio.gather(*runners)
+    await finished.put(None)
+    await harvester
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Generate, run and harvest the decks for XRD.csv "
+                    "as one pipeline")
+    parser.add_argument('-i', '--input', default='XRD.csv',
+                        help="XRD table (csv, Parquet or Arrow IPC)")
+    parser.add_argument('--chunksize', type=int, default=1000,
+                        help="rows of the XRD table read at a time")
+    parser.add_argument('--repeats', type=int, default=10,
+                        help="number of runs (decks) per formation")
+    parser.add_argument('--study-seed', type=int, default=0)
+    parser.add_argument('--runner', choices=('local', 'condor'),
+                        default='local')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="runs at once (local) or jobs in the queue "
+                             "(condor)")
+    parser.add_argument('--replace', action='append', default=[],
+                        metavar='NAME=PATH',
+                        help="as for localrun.py, e.g. "
+                             "mcnp611.sh=fakemcnp.py")
+    parser.add_argument('--scratch', help="where to make job directories")
+    parser.add_argument('--poll', type=float, default=30.0,
+                        help="seconds between looks at Condor job logs")
+    parser.add_argument('--max-pending', type=int,
+                        help="decks that may wait to run (default: twice "
+                             "--jobs)")
+    parser.add_argument('--mctal', action='store_true',
+                        help="have MCNP write mctal files, and read those")
+    parser.add_argument('-o', '--output', default='data.csv',
+                        help="csv file to append results to")
+    parser.add_argument('--store',
+                        help="results store to record the runs in, and to "
+                             "skip the formations that are done")
+    parser.add_argument('--target-relerr', type=float,
+                        help="with --store, skip the formations whose "
+                             "combined relative error is this small")
+    parser.add_argument('--first-deck', type=int,
+                        help="number of the first deck (default: one after "
+                             "the last deck in the store and manifest.csv)")
+    parser.add_argument('--cleanup', action='store_true',
+                        help="delete each deck and its runtape once it "
+                             "has been harvested")
+    parser.add_argument('--report', default='pipeline-report.json',
+                        help="JSON file for the run's stage timings and "
+                             "counters ('' for none)")
+    args = parser.parse_args(args)
+    with instrument.session(args.report, program='pipeline'):
+        fp = open("ctn8tmpl")
+        deck_template = fp.read()
+        fp.close()
+        if args.mctal:
+            deck_template = getdecks.request_mctal(deck_template)
+        deck_template = getdecks.DeckTemplate(deck_template)
+        sweep = getdecks.get_sweep(getdecks.POROSITIES, getdecks.MICA_PCTS,
+                                   getdecks.SMECTITE_PCTS)
+        if args.first_deck is None:
+            args.first_deck = getdecks.get_next_deck(args.store,
+                                                     'manifest.csv')
+        rows = write_rows(deck_template,
+                          getdecks.read_xrd(args.input, args.chunksize),
+                          sweep, args.repeats,
+                          getdecks.count_xrd_rows(args.input),
+                          args.study_seed, args.store, args.target_relerr,
+                          args.first_deck)
+        if args.runner == 'condor':
+            runner = CondorRunner(args.jobs, args.mctal, args.poll)
+        else:
+            runner = LocalRunner(args.jobs,
+                                 dict(item.split('=', 1)
+                                      for item in args.replace),
+                                 args.mctal, args.scratch)
+        manifestfp = open('manifest.csv', 'w', newline='')
+        try:
+            asyncio.run(pipeline(rows, runner, manifestfp, args.output,
+                                 args.store, args.max_pending, args.cleanup))
+        finally:
+            manifestfp.close()
+            runner.close()
+    return 1 if instrument.STATS.counters['runs_failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
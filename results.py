@@ -0,0 +1,185 @@
+"""Store of MCNP results keyed by formation, shared between studies.
+
+   Every deck getdecks.py writes has a formation key (see
+   getdecks.get_formation_key), a hash of the formation's material card,
+   its density and the deck template, i.e. of everything the physics of
+   the run depends on apart from the random seed. ouextract.py --store
+   records each harvested run under its key in an SQLite database, and
+   getdecks.py --store skips the formations that already have enough good
+   runs there, whichever study they were run for. The runs of a formation
+   are combined into one inverse-variance weighted estimate (combine),
+   which adaptive.py uses to decide which formations need more runs.
+"""
+import csv
+import itertools
+import os
+import sqlite3
+
+RUN_COLUMNS = ('formation', 'rand_seed', 'deck', 'well', 'sample',
+               'porosity', 'pct_mica', 'pct_smectite', 'formation_density',
+               'dose', 'relerr', 'stats_failed')
+
+_SCHEMA = """CREATE TABLE IF NOT EXISTS runs (
+    formation TEXT NOT NULL,
+    rand_seed INTEGER NOT NULL,
+    deck TEXT,
+    well TEXT,
+    sample INTEGER,
+    porosity REAL,
+    pct_mica REAL,
+    pct_smectite REAL,
+    formation_density REAL,
+    dose REAL,
+    relerr REAL,
+    stats_failed INTEGER,
+    PRIMARY KEY (formation, rand_seed))"""
+
+
+class ResultsStore(object):
+    """The runs table of an SQLite database, one row per MCNP run.
+
+       A run is identified by its formation key and random seed, so
+       harvesting the same output again replaces its row.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute(_SCHEMA)
+        self.db.commit()
+
+    def add_runs(self, runs):
+        "Add or replace 'runs', dicts with the keys of RUN_COLUMNS"
+        self.db.executemany(
+            'INSERT OR REPLACE INTO runs (%s) VALUES (%s)'
+            % (', '.join(RUN_COLUMNS), ', '.join('?'*len(RUN_COLUMNS))),
+            [tuple(run.get(column) for column in RUN_COLUMNS)
+             for run in runs])
+        self.db.commit()
+
+    def num_runs(self, formation):
+        """Return the number of runs of 'formation' that passed MCNP's
+           statistical checks; runs without a stats_failed (read from
+           mctal files) are not known to have passed, so don't count"""
+        return self.db.execute(
+            'SELECT COUNT(*) FROM runs WHERE formation = ? '
+            'AND stats_failed = 0', (formation,)).fetchone()[0]
+
+    def has_run(self, formation, rand_seed):
+        "Return whether the run of 'formation' with 'rand_seed' is stored"
+        return self.db.execute(
+            'SELECT 1 FROM runs WHERE formation = ? AND rand_seed = ?',
+            (formation, rand_seed)).fetchone() is not None
+
+    def last_deck(self):
+        "Return the number of the highest-numbered deck stored, or 0"
+        return self.db.execute(
+            'SELECT MAX(CAST(SUBSTR(deck, 2) AS INTEGER)) FROM runs'
+            ).fetchone()[0] or 0
+
+    def get_estimate(self, formation):
+        "Return combine()'s estimate of the dose of 'formation'"
+        return combine((dose, relerr) for dose, relerr, stats_failed
+                       in self.get_runs(formation))
+
+    def is_done(self, formation, num_runs, target_relerr=None):
+        """Return whether 'formation' needs no more runs: with a
+           'target_relerr', whether its combined estimate is that good,
+           and otherwise whether it has 'num_runs' runs that passed the
+           statistical checks"""
+        if target_relerr is None:
+            return self.num_runs(formation) >= num_runs
+        dose, relerr, n = self.get_estimate(formation)
+        return n > 0 and relerr <= target_relerr
+
+    def estimates(self):
+        """Yield a dict per formation with the sweep point and density of
+           its first run, and the combined dose, relerr and number of runs"""
+        cursor = self.db.execute(
+            'SELECT formation, well, sample, porosity, pct_mica, pct_smectite, '
+            'formation_density, dose, relerr FROM runs '
+            'ORDER BY formation, rand_seed')
+        for formation, rows in itertools.groupby(cursor, lambda r: r[0]):
+            rows = list(rows)
+            estimate = dict(zip(ESTIMATE_COLUMNS[:7], rows[0][:7]))
+            (estimate['dose'], estimate['relerr'],
+             estimate['runs']) = combine(row[7:] for row in rows)
+            yield estimate
+
+    def get_runs(self, formation):
+        "Return a list of (dose, relerr, stats_failed) for 'formation'"
+        return self.db.execute(
+            'SELECT dose, relerr, stats_failed FROM runs WHERE formation = ? '
+            'ORDER BY rand_seed', (formation,)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+ESTIMATE_COLUMNS = ('formation', 'well', 'sample', 'porosity', 'pct_mica',
+                    'pct_smectite', 'formation_density', 'dose', 'relerr',
+                    'runs')
+
+
+def combine(runs):
+    """Return the inverse-variance weighted mean of the doses of 'runs',
+       (dose, relerr) pairs, its relative error and the number of runs
+       used. Runs without a positive dose and relerr are left out; with
+       none left, returns (None, None, 0).
+
+       >>> combine([(2.0, 0.1), (2.0, 0.1), (None, None)])
+       (2.0, 0.07071067811865475, 2)
+    """
+    total_weight = total = 0.0
+    n = 0
+    for dose, relerr in runs:
+        if not dose or not relerr or dose <= 0 or relerr <= 0:
+            continue
+        weight = 1.0/(dose*relerr)**2
+        total_weight += weight
+        total += weight*dose
+        n += 1
+    if n == 0:
+        return None, None, 0
+    mean = total/total_weight
+    return mean, total_weight**-0.5/mean, n
+
+
+def get_deck(oufile):
+    "Return the deck name (e.g. 's00001') of output file 'oufile'"
+    name = os.path.basename(oufile)
+    return name[:-2] if name.endswith('ou') else name
+
+
+def read_manifest_records(manifestfile):
+    "Return a dict of deck name -> manifest record (a dict) for every deck"
+    fp = open(manifestfile, newline='')
+    records = dict((record['filename'], record)
+                   for record in csv.DictReader(fp))
+    fp.close()
+    return records
+
+
+def get_last_deck(manifestfile):
+    "Return the number of the last deck in a getdecks.py manifest, or 0"
+    if not os.path.exists(manifestfile):
+        return 0
+    return max([int(filename.lstrip('s'))
+                for filename in read_manifest_records(manifestfile)] or [0])
+
+
+def get_runs(rows, manifest):
+    """Return store runs for harvested data 'rows' (see ouextract.harvest),
+       taking each run's formation and seed from the 'manifest' records of
+       read_manifest_records. Rows of decks not in the manifest (or
+       written before it had formation keys) are left out."""
+    runs = []
+    for data in rows:
+        record = manifest.get(get_deck(data['oufile']))
+        if record is None or not record.get('formation'):
+            continue
+        run = dict((column, record.get(column)) for column in RUN_COLUMNS)
+        run['deck'] = record['filename']
+        for column in ('dose', 'relerr', 'stats_failed'):
+            run[column] = data.get(column)
+        runs.append(run)
+    return runs
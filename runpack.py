@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+"""Run a pack of MCNP decks one after another in a single job.
+
+   This is the executable of the packed submit description written by
+   getdecks.py --pack: it unpacks the job's decks from their tar archive
+   and runs MCNP on each, so the job transfers the weight windows and
+   starts up once for all of them. The archives written by getdecks.py
+   --archive-size work the same way; their decks may be gzipped members
+   ('<deck>in.gz'), and given the archive's index (--index, the
+   '<pack>.index.csv' getdecks.py writes beside it and sends with the job)
+   or the study's manifest, each deck is read straight from its offset
+   instead of by scanning the archive.
+"""
+import argparse
+import csv
+import gzip
+import os
+import shlex
+import subprocess
+import sys
+import tarfile
+
+
+def get_mcnp_command(mcnp, deck, wwinp='ctn8ww', mctal=False):
+    """Return the command line that runs deck 'deck' (e.g. 's00001'),
+       naming its mctal file '<deck>mc' if 'mctal'"""
+    command = shlex.split(mcnp)
+    if os.path.exists(command[0]) and not os.path.dirname(command[0]):
+        command[0] = os.path.join(os.curdir, command[0])
+    command += ['inp=%sin' % deck, 'wwinp=%s' % wwinp,
+                'ou=%sou' % deck, 'ru=%sta' % deck]
+    if mctal:
+        command.append('mctal=%smc' % deck)
+    return command
+
+
+def read_index(manifestfile, archive):
+    """Return a dict of deck -> (offset, size) for the decks
+       of 'archive' in a getdecks.py manifest"""
+    index = {}
+    name = os.path.basename(archive)
+    fp = open(manifestfile, newline='')
+    for record in csv.DictReader(fp):
+        if os.path.basename(record.get('archive') or '') == name:
+            index[record['filename']] = (int(record['offset']),
+                                         int(record['size']))
+    fp.close()
+    return index
+
+
+def _write_deck(deck, data, compressed):
+    fp = open('%sin' % deck, 'wb')
+    fp.write(gzip.decompress(data) if compressed else data)
+    fp.close()
+
+
+def extract_decks(archive, decks, index=None):
+    """Extract the input files of 'decks' from tar archive 'archive'.
+
+       With an 'index' from read_index, each deck is read from its offset;
+       otherwise the archive's members are scanned for them.
+    """
+    if index is not None and all(deck in index for deck in decks):
+        fp = open(archive, 'rb')
+        try:
+            for deck in decks:
+                offset, size = index[deck]
+                fp.seek(offset)
+                data = fp.read(size)
+                # gzipped members start with the gzip magic number
+                _write_deck(deck, data, data[:2] == b'\x1f\x8b')
+        finally:
+            fp.close()
+        return
+    wanted = set('%sin' % deck for deck in decks)
+    tar = tarfile.open(archive)
+    try:
+        for member in tar:
+            name = member.name
+            compressed = name.endswith('.gz')
+            if compressed:
+                name = name[:-3]
+            if name in wanted:
+                data = tar.extractfile(member).read()
+                _write_deck(name[:-2], data, compressed)
+    finally:
+        tar.close()
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Run MCNP on several decks in turn")
+    parser.add_argument('decks', nargs='+',
+                        help="deck names, without the 'in' suffix")
+    parser.add_argument('--archive',
+                        help="tar archive to take the decks from")
+    parser.add_argument('--index',
+                        help="the archive's index, or a getdecks.py "
+                             "manifest, giving the decks' offsets in it")
+    parser.add_argument('--mcnp', default='mcnp611.sh',
+                        help="MCNP command")
+    parser.add_argument('--wwinp', default='ctn8ww',
+                        help="weight-window file")
+    parser.add_argument('--mctal', action='store_true',
+                        help="name each deck's mctal file <deck>mc")
+    args = parser.parse_args(args)
+    if args.archive:
+        index = read_index(args.index, args.archive) if args.index else None
+        extract_decks(args.archive, args.decks, index)
+    failed = []
+    for deck in args.decks:
+        status = subprocess.call(get_mcnp_command(args.mcnp, deck, args.wwinp,
+                                                  args.mctal))
+        if status != 0:
+            sys.stderr.write("%s: %s exited with status %d\n"
+                             % (deck, args.mcnp, status))
+            failed.append(deck)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#! /usr/bin/env python
+"""Propagate the uncertainty of the XRD weight percents into the formations.
+
+   For every sample of the XRD table, draws many perturbed mineral
+   compositions (getdecks.draw_xrd), mixes them all as arrays and writes
+   the quantiles of the formation density and of each element fraction
+   to a csv; optionally also a material card for each quantile.
+"""
+import argparse
+import csv
+import sys
+
+import getdecks
+import instrument
+import mcnpelements as el
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Monte Carlo the XRD uncertainty of the cuttings in "
+                    "XRD.csv into formation densities and compositions")
+    parser.add_argument('-i', '--input', default='XRD.csv',
+                        help="XRD table (csv, Parquet or Arrow IPC)")
+    parser.add_argument('--draws', type=int, default=1000,
+                        help="perturbed compositions per sample")
+    parser.add_argument('--method', choices=('dirichlet', 'gaussian'),
+                        default='dirichlet')
+    parser.add_argument('--concentration', type=float, default=200.0,
+                        help="Dirichlet concentration (larger is tighter)")
+    parser.add_argument('--sd', type=float, default=1.0,
+                        help="Gaussian standard deviation, in weight percent")
+    parser.add_argument('--quantiles', default='0.05,0.5,0.95',
+                        help="comma-separated quantiles to report")
+    parser.add_argument('--porosity', type=float,
+                        default=getdecks.POROSITIES[0])
+    parser.add_argument('--pct-mica', type=float,
+                        default=getdecks.MICA_PCTS[0])
+    parser.add_argument('--pct-smectite', type=float,
+                        default=getdecks.SMECTITE_PCTS[0])
+    parser.add_argument('--seed', type=int, help="random seed")
+    parser.add_argument('--max-formations', type=int, default=1 << 18,
+                        help="formations mixed at a time, to bound memory")
+    parser.add_argument('-o', '--output', default='ensemble.csv',
+                        help="csv of the quantiles")
+    parser.add_argument('--cards', help="write a material card per sample "
+                                        "and quantile to this file")
+    parser.add_argument('--report', default='',
+                        help="JSON file for the run's stage timings and "
+                             "counters")
+    args = parser.parse_args(args)
+    quantiles = [float(q) for q in args.quantiles.split(',')]
+    with instrument.session(args.report, program='xrdensemble'):
+        mixdf = getdecks.read_xrd(args.input)
+        inputs = getdecks.get_jacobian_inputs(mixdf, args.porosity,
+                                              args.pct_mica,
+                                              args.pct_smectite)
+        with instrument.stage('ensemble'):
+            density_q, elem_q = getdecks.xrd_ensemble(
+                inputs, args.draws, quantiles, args.max_formations,
+                method=args.method, concentration=args.concentration,
+                sd=args.sd, rng=args.seed)
+        fp = open(args.output, 'w', newline='')
+        writer = csv.writer(fp)
+        writer.writerow(['well', 'sample', 'quantile', 'formation_density']
+                        + list(el.ELEMENT_ORDER))
+        for n, (idx, row) in enumerate(mixdf.iterrows()):
+            for i, q in enumerate(quantiles):
+                writer.writerow([row['well'], row['sample'], q,
+                                 density_q[i, n]] + elem_q[i, n].tolist())
+        fp.close()
+        if args.cards:
+            names = [getdecks.get_name(row, args.pct_mica, args.pct_smectite)
+                     for idx, row in mixdf.iterrows()]
+            fp = open(args.cards, 'w')
+            fp.write('\n'.join(getdecks.get_quantile_cards(
+                names, quantiles, density_q, elem_q)) + '\n')
+            fp.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())